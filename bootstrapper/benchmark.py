@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import argparse
+import config
+from log import *
+from concurrent.futures import ThreadPoolExecutor
+from fake_proxmox import FakeProxmox, FakeProxmoxServer, DURATIONS
+
+# Measures the time until reset runner VMs are running against the fake Proxmox API
+# Every reset mode is timed for a single VM and for all VMs at once, together with the number of API requests
+# Each VM is reset and started by the code of the bootstrapper in its own thread, like concurrent bootstrappers would
+# Results are written as JSON, --compare prints the difference to the results of a previous run
+
+NODE = "pve"
+BACKUP_STORAGE = "backup"
+SNAPSHOT = "clean"
+TEMPLATE = "9000"
+MODES = ["backup", "snapshot", "clone"]
+
+def time_to_ready(reset, fake, mode, vmids):
+    for vmid in vmids:
+        fake.set_status(vmid, "stopped")
+    requests = fake.requests
+    start = time.time()
+    with ThreadPoolExecutor(len(vmids)) as executor:
+        for future in [executor.submit(reset.reset_and_start, vmid, mode) for vmid in vmids]:
+            future.result()
+    return {
+        "seconds": time.time() - start,
+        "requests": fake.requests - requests
+    }
+
+def benchmark(args):
+    vmids = [str(100 + i) for i in range(1, args.vms + 1)]
+    durations = { "qmrestore": args.restore_seconds, "qmstart": args.start_seconds }
+    fake = FakeProxmox(NODE, vmids, TEMPLATE, BACKUP_STORAGE, durations, args.failure_rate)
+    results = {}
+
+    with FakeProxmoxServer(fake) as server:
+        os.environ.update(
+            PVE_PROXMOX_HOST = server.url,
+            PVE_NODE = NODE,
+            PVE_BACKUP_STORAGE = BACKUP_STORAGE,
+            PVE_RUNNER_SNAPSHOT = SNAPSHOT,
+            PVE_RUNNER_TEMPLATE = TEMPLATE,
+            PVE_API_USER = "benchmark@pve!token",
+            PVE_API_TOKEN = "secret"
+        )
+        config.initialize(os.devnull)
+        import reset
+
+        for mode in args.modes:
+            single = time_to_ready(reset, fake, mode, vmids[:1])
+            log("BENCHMARK", f"{mode}, 1 VM: {single['seconds']:.2f}s, {single['requests']} requests")
+            pool = time_to_ready(reset, fake, mode, vmids)
+            log("BENCHMARK", f"{mode}, {len(vmids)} VMs: {pool['seconds']:.2f}s, {pool['requests']} requests")
+            results[mode] = { "single": single, "pool": pool }
+
+    return {
+        "config": {
+            "vms": args.vms,
+            "restore_seconds": args.restore_seconds,
+            "start_seconds": args.start_seconds,
+            "failure_rate": args.failure_rate
+        },
+        "results": results
+    }
+
+def print_results(report, baseline = None):
+    log("BENCHMARK", f"{'Scenario':<18}{'Seconds':>10}{'Requests':>10}{'Baseline':>10}{'Change':>9}")
+    for mode, result in report["results"].items():
+        for scenario in ["single", "pool"]:
+            line = f"{mode + ' ' + scenario:<18}{result[scenario]['seconds']:>10.2f}{result[scenario]['requests']:>10}"
+            previous = baseline["results"].get(mode, {}).get(scenario) if baseline else None
+            if previous:
+                change = (result[scenario]["seconds"] - previous["seconds"]) / previous["seconds"] * 100 if previous["seconds"] else 0.0
+                line += f"{previous['seconds']:>10.2f}{change:>+8.1f}%"
+            log("BENCHMARK", line)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark of the time until runner VMs are ready against a fake Proxmox API")
+    parser.add_argument("--vms", type = int, default = 4)
+    parser.add_argument("--modes", nargs = "+", default = MODES, choices = MODES)
+    parser.add_argument("--restore-seconds", type = float, default = DURATIONS["qmrestore"], help = "Duration of a backup restore task")
+    parser.add_argument("--start-seconds", type = float, default = DURATIONS["qmstart"], help = "Duration of a start task")
+    parser.add_argument("--failure-rate", type = float, default = 0.0, help = "Fraction of GET requests failing with 503")
+    parser.add_argument("--output", help = "Write the results as JSON to this file")
+    parser.add_argument("--compare", help = "JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            log("BENCHMARK", "The configuration of the baseline differs, the results might not be comparable")
+    print_results(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
+        log("BENCHMARK", f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
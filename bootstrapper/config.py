@@ -4,19 +4,26 @@ import os
 PROXMOX_HOST = None
 NODE = None
 RUNNER_VMID = None
+RUNNER_VMIDS = []
 BACKUP_STORAGE = None
 RUNNER_BACKUP = None
+RUNNER_SNAPSHOT = None
+RUNNER_TEMPLATE = None
 API_USER = None
 API_TOKEN = None
 
 def initialize(dotenv_path = None):
     load_dotenv(dotenv_path, override = True)
 
-    global PROXMOX_HOST, NODE, RUNNER_VMID, BACKUP_STORAGE, RUNNER_BACKUP, API_USER, API_TOKEN
+    global PROXMOX_HOST, NODE, RUNNER_VMID, RUNNER_VMIDS, BACKUP_STORAGE, RUNNER_BACKUP, RUNNER_SNAPSHOT, RUNNER_TEMPLATE, API_USER, API_TOKEN
     PROXMOX_HOST = os.getenv("PVE_PROXMOX_HOST")
     NODE = os.getenv("PVE_NODE")
     RUNNER_VMID = os.getenv("PVE_RUNNER_VMID")
+    # Pool of interchangeable runner VMs, a single RUNNER_VMID is a pool of one
+    RUNNER_VMIDS = [vmid.strip() for vmid in (os.getenv("PVE_RUNNER_VMIDS") or RUNNER_VMID or "").split(",") if vmid.strip()]
     BACKUP_STORAGE = os.getenv("PVE_BACKUP_STORAGE")
     RUNNER_BACKUP = os.getenv("PVE_RUNNER_BACKUP")
+    RUNNER_SNAPSHOT = os.getenv("PVE_RUNNER_SNAPSHOT")
+    RUNNER_TEMPLATE = os.getenv("PVE_RUNNER_TEMPLATE")
     API_USER = os.getenv("PVE_API_USER")
     API_TOKEN = os.getenv("PVE_API_TOKEN")
@@ -0,0 +1,182 @@
+import re
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from log import *
+
+# Stand-in for the parts of the Proxmox API used by the bootstrapper, to try out changes and benchmark without a cluster
+# Tasks take a configurable time and write progress lines to their log, VMs change their status once their task is done
+# The state is only advanced when it is read, so no background threads are needed
+
+DURATIONS = {
+    "qmrestore": 3.0,
+    "qmrollback": 0.5,
+    "qmclone": 0.5,
+    "qmdestroy": 0.2,
+    "qmstart": 1.0,
+    "qmstop": 0.5,
+    "qmshutdown": 2.0
+}
+PROGRESS_STEPS = 10
+
+class FakeProxmox:
+    def __init__(self, node = "pve", vmids = None, template = None, backup_storage = "backup", durations = None, failure_rate = 0.0):
+        self.lock = threading.Lock()
+        self.node = node
+        self.backup_storage = backup_storage
+        self.durations = DURATIONS | (durations or {})
+        # Fraction of GET requests answered with 503, to exercise the retries of the client
+        # Requests which start tasks are not retried on an error status, a failure would end the run
+        self.failure_rate = failure_rate
+        self.vms = { str(vmid): "stopped" for vmid in vmids or [] }
+        self.template = str(template) if template else None
+        if self.template:
+            self.vms[self.template] = "stopped"
+        # upid -> [type, vmid, start time, duration, error, applied, silent]
+        self.tasks = {}
+        self.task_count = 0
+        self.requests = 0
+
+    def set_status(self, vmid, status):
+        with self.lock:
+            self.vms[str(vmid)] = status
+
+    def add_task(self, task_type, vmid, error = None, silent = False):
+        # A silent task never writes to its log, like a worker that is killed, so it also stops without a TASK line
+        self.task_count += 1
+        upid = f"UPID:{self.node}:{self.task_count:08X}:{int(time.time()):08X}:{task_type}:{vmid}:root@pam:"
+        self.tasks[upid] = [task_type, vmid, time.time(), self.durations[task_type], error, False, silent]
+        return upid
+
+    def advance(self):
+        now = time.time()
+        for task in self.tasks.values():
+            task_type, vmid, start, duration, error, applied, silent = task
+            if applied or now - start < duration:
+                continue
+            task[5] = True
+            if error:
+                continue
+            if task_type == "qmstart":
+                self.vms[vmid] = "running"
+            elif task_type in ["qmstop", "qmshutdown", "qmrestore", "qmrollback", "qmclone"]:
+                self.vms[vmid] = "stopped"
+            elif task_type == "qmdestroy":
+                self.vms.pop(vmid, None)
+
+    def task_log(self, upid):
+        task_type, vmid, start, duration, error, applied, silent = self.tasks[upid]
+        if silent:
+            return []
+        lines = [f"{task_type} VM {vmid}"]
+        if error:
+            return lines + [f"TASK ERROR: {error}"] if applied else lines
+        progress = min(1.0, (time.time() - start) / duration) if duration else 1.0
+        lines += [f"progress {step * 100 // PROGRESS_STEPS}%" for step in range(1, int(progress * PROGRESS_STEPS) + 1)]
+        return lines + ["TASK OK"] if applied else lines
+
+    def handle(self, method, path, query, form):
+        # Returns (status code, data)
+        with self.lock:
+            self.requests += 1
+            if method == "GET" and self.failure_rate and random.random() < self.failure_rate:
+                return (503, None)
+            self.advance()
+
+            prefix = f"/api2/json/nodes/{self.node}"
+            if method == "GET" and path == f"{prefix}/qemu":
+                return (200, [{ "vmid": int(vmid), "status": status, "template": int(vmid == self.template) } for vmid, status in self.vms.items()])
+            if method == "POST" and path == f"{prefix}/qemu":
+                vmid = form["vmid"]
+                error = "VM is running" if self.vms.get(vmid) == "running" else None
+                self.vms.setdefault(vmid, "stopped")
+                return (200, self.add_task("qmrestore", vmid, error))
+            if method == "GET" and path == f"{prefix}/storage/{self.backup_storage}/content":
+                return (200, [
+                    { "content": "backup", "volid": f"{self.backup_storage}:backup/vzdump-qemu-{vmid}-2024_01_01-00_00_00.vma.zst", "ctime": 1704067200 }
+                    for vmid in self.vms
+                ])
+
+            match = re.fullmatch(f"{prefix}/qemu/(\\d+)(/.*)?", path)
+            if match:
+                vmid, action = match.group(1), match.group(2) or ""
+                if vmid not in self.vms:
+                    return (500, None)
+                if method == "GET" and action == "/status/current":
+                    return (200, { "vmid": int(vmid), "status": self.vms[vmid] })
+                if method == "POST" and action in ["/status/start", "/status/stop", "/status/shutdown"]:
+                    return (200, self.add_task(f"qm{action.rsplit('/', 1)[1]}", vmid))
+                if method == "POST" and re.fullmatch("/snapshot/[^/]+/rollback", action):
+                    error = "VM is running" if self.vms[vmid] == "running" else None
+                    return (200, self.add_task("qmrollback", vmid, error))
+                if method == "POST" and action == "/clone":
+                    newid = form["newid"]
+                    if newid in self.vms:
+                        return (500, None)
+                    self.vms[newid] = "locked"
+                    return (200, self.add_task("qmclone", newid))
+                if method == "DELETE" and action == "":
+                    error = "VM is running" if self.vms[vmid] == "running" else None
+                    return (200, self.add_task("qmdestroy", vmid, error))
+
+            match = re.fullmatch(f"{prefix}/tasks/([^/]+)/(status|log)", path)
+            if match and method == "GET" and match.group(1) in self.tasks:
+                upid = match.group(1)
+                error, applied = self.tasks[upid][4:6]
+                if match.group(2) == "status":
+                    return (200, { "status": "stopped", "exitstatus": error or "OK" } if applied else { "status": "running" })
+                start = int(query.get("start", ["0"])[0])
+                limit = int(query.get("limit", ["50"])[0])
+                lines = self.task_log(upid)
+                # Like Proxmox, an empty log is returned as a single placeholder line
+                if not lines:
+                    return (200, [{ "n": 1, "t": "no content" }])
+                return (200, [{ "n": start + i + 1, "t": line } for i, line in enumerate(lines[start:start + limit])])
+            return (501, None)
+
+class FakeProxmoxServer:
+    def __init__(self, proxmox, port = 0):
+        self.proxmox = proxmox
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def respond(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                form = { key: values[0] for key, values in parse_qs(self.rfile.read(length).decode("utf-8")).items() }
+                status, data = proxmox.handle(self.command, url.path, parse_qs(url.query), form)
+                body = json.dumps({ "data": data }).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = respond
+            do_POST = respond
+            do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+        log("FAKE_PVE", f"Fake Proxmox API listening on {self.url}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import proxmox_vm
+from log import *
+
+# The lock file of the cache action is shared, its directory is appended so the modules of the bootstrapper take precedence
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache"))
+from filelock import LockFile
+
+QUEUE_DIR = ".queue"
+POLL_INTERVAL = 5
+
+# Leases idle runner VMs to concurrent bootstrappers in the order they arrived
+# Waiting bootstrappers form a queue of ticket lock files, each one blocks on the lock of its predecessor
+# Only the head of the queue looks for an idle VM, a VM is idle if it is stopped and nobody holds its lock
+# A VM which doesn't exist (a destroyed linked clone) is idle as well, it is created again by the reset
+# The lock of a VM is held while it is reset and started, once it is running it is busy until the runner shuts it down
+# VMs of the Standby were reset and started ahead of time, they are handed out before resetting an idle VM
+class RunnerPool:
+    def __init__(self, path, vmids, standby = None):
+        self.path = path
+        self.vmids = vmids
+        self.standby = standby
+        self.queue_path = os.path.join(path, QUEUE_DIR)
+
+    def vm_lock_path(self, vmid):
+        return os.path.join(self.path, f".lock-{vmid}")
+
+    def ticket_path(self, ticket):
+        return os.path.join(self.queue_path, f"{ticket}.lock")
+
+    def enter_queue(self, timeout):
+        # Returns the held lock of the own ticket once all earlier tickets got a lease or gave up
+        os.makedirs(self.queue_path, exist_ok = True)
+        with LockFile(os.path.join(self.queue_path, ".lock"), wait_interval = None):
+            tail_path = os.path.join(self.queue_path, "tail")
+            ticket = 1
+            if os.path.exists(tail_path):
+                with open(tail_path, "r") as f:
+                    ticket = int(f.read().strip() or 0) + 1
+            with open(tail_path, "w") as f:
+                f.write(str(ticket))
+            # The ticket is locked before the queue is unlocked, so the successor can never acquire it too early
+            own_ticket = LockFile(self.ticket_path(ticket))
+            own_ticket.try_acquire()
+
+        predecessor = self.ticket_path(ticket - 1)
+        if os.path.exists(predecessor):
+            log("POOL", f"Waiting in the runner queue (ticket {ticket})")
+            try:
+                with LockFile(predecessor, timeout = timeout, wait_interval = None):
+                    pass
+            except:
+                own_ticket.release()
+                raise
+            os.remove(predecessor)
+        return own_ticket
+
+    def try_lease(self, statuses):
+        for vmid in self.vmids:
+            if statuses.get(vmid, "stopped") != "stopped":
+                continue
+            lock = LockFile(self.vm_lock_path(vmid))
+            if not lock.try_acquire():
+                continue
+            # The status might be from before another bootstrapper started the VM and released its lock
+            if proxmox_vm.get_vm_statuses().get(vmid, "stopped") == "stopped":
+                return (vmid, lock)
+            lock.release()
+        return None
+
+    def lease(self, timeout):
+        # Returns (vmid, held lock of the VM), the lock is None for a prepared VM which is already running
+        deadline = time.time() + timeout
+        ticket = self.enter_queue(timeout)
+        try:
+            waiting = False
+            while True:
+                statuses = proxmox_vm.get_vm_statuses()
+                vmid = self.standby.claim(statuses) if self.standby else None
+                if vmid:
+                    log("POOL", f"Leased prepared VM {vmid}")
+                    return (vmid, None)
+                lease = self.try_lease(statuses)
+                if lease:
+                    log("POOL", f"Leased VM {lease[0]}")
+                    return lease
+                if time.time() > deadline:
+                    raise TimeoutError(f"No runner VM of {', '.join(self.vmids)} became idle")
+                if not waiting:
+                    log("POOL", f"All runner VMs ({', '.join(self.vmids)}) are busy, waiting...")
+                    waiting = True
+                time.sleep(POLL_INTERVAL)
+        finally:
+            ticket.release()
@@ -2,6 +2,8 @@
 # For more info: Use dev tools in browser to see the requests made by the web interface
 
 import requests
+import urllib3
+import random
 import time
 from log import *
 from config import PROXMOX_HOST, NODE, API_USER, API_TOKEN
@@ -10,23 +12,73 @@ HEADERS = {
     "Authorization": f"PVEAPIToken={API_USER}={API_TOKEN}"
 }
 
-def get(url):
-    resp = requests.get(url, headers = HEADERS)
-    resp.raise_for_status()
-    return resp.json()
+REQUEST_TIMEOUT = 30
+RETRIES = 5
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 10
+# Proxmox answers most errors with 500, which are not retried, 595 and 596 are connection errors of the proxy to the node
+RETRY_STATUS = [502, 503, 504, 595, 596]
+
+MIN_WAIT_INTERVAL = 0.5
+MAX_WAIT_INTERVAL = 5
+
+# Keeps the connection (and TLS session) to the API open between requests
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize = 16))
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize = 16))
+
+def backoff(attempt):
+    # Exponential with jitter, so concurrent bootstrappers don't retry in lockstep
+    return min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def is_unsent(error):
+    # Whether the request failed while connecting, so it never reached the API
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def request(method, url, **kwargs):
+    # POST and DELETE start tasks, after a read timeout, a dropped connection or an error status from a proxy
+    # the task may be running already, so they are only retried if the request was never sent
+    for attempt in range(RETRIES + 1):
+        try:
+            resp = SESSION.request(method, url, timeout = REQUEST_TIMEOUT, **kwargs)
+            if method != "GET" or resp.status_code not in RETRY_STATUS or attempt == RETRIES:
+                resp.raise_for_status()
+                return resp.json()
+            error = f"status {resp.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == RETRIES or (method != "GET" and not is_unsent(e)):
+                raise
+            error = str(e)
+        delay = backoff(attempt)
+        log("PVE", f"{method} {url} failed ({error}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+def get(url, params = None):
+    return request("GET", url, params = params)
 
 def post(url, data = None):
-    resp = requests.post(url, data = data, headers = HEADERS)
-    resp.raise_for_status()
-    return resp.json()
+    return request("POST", url, data = data)
+
+def delete(url, params = None):
+    return request("DELETE", url, params = params)
 
 def get_vm_status(vmid):
     json = get(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/status/current")
     return json["data"]["status"]
 
+def get_vm_statuses():
+    # Status of all VMs of the node with a single request, vmid -> status
+    json = get(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu")
+    return { str(vm["vmid"]): vm["status"] for vm in json["data"] }
+
 def start_vm(vmid):
-    post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/status/start")
+    resp = post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/status/start")
     log("PVE", f"VM {vmid} start requested")
+    return resp["data"]
 
 def stop_vm(vmid):
     post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/status/stop")
@@ -36,14 +88,15 @@ def shutdown_vm(vmid):
     post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/status/shutdown")
     log("PVE", f"VM {vmid} shutdown requested")
 
-def wait_vm_status(vmid, desired_status, interval = 5):
-    log("PVE", f"Waiting for VM {vmid} to be in \"{desired_status}\" state...")
-    while True:
-        status = get_vm_status(vmid)
-        log("PVE", f"Current status: {status}")
-        if status == desired_status:
-            break
-        time.sleep(interval)
+def wait_vm_status(vmid, desired_status, timeout = None):
+    wait_vm_statuses({ vmid: desired_status }, timeout)
+
+def wait_vm_statuses(desired_statuses, timeout = None):
+    # vmid -> status
+    engine = WaitEngine()
+    for vmid, status in desired_statuses.items():
+        engine.add_status(vmid, status)
+    engine.run(timeout)
 
 def get_latest_backup_filename(vmid, backup_storage):
     json = get(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/storage/{backup_storage}/content")
@@ -51,26 +104,93 @@ def get_latest_backup_filename(vmid, backup_storage):
     backups.sort(key = lambda n: n["ctime"], reverse = True)
     return backups[0]["volid"] if backups else None
 
-def wait_for_task_completion(upid, interval = 5, timeout = 900):
-    start_time = time.time()
-    url = f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/tasks/{upid}/status"
-    
-    while True:
-        elapsed_time = time.time() - start_time
-        if elapsed_time > timeout:
-            raise TimeoutError("Timeout")
-        
-        status_resp = get(url)
-        status = status_resp["data"]["status"]
-        if status == "stopped":
-            exitstatus = status_resp["data"]["exitstatus"]
-            if exitstatus == "OK":
-                log("PVE", "Restore completed successfully.")
+def wait_for_task_completion(upid, timeout = 900):
+    wait_for_tasks([upid], timeout)
+
+def wait_for_tasks(upids, timeout = 900):
+    engine = WaitEngine()
+    for upid in upids:
+        engine.add_task(upid)
+    engine.run(timeout)
+
+def get_task_status(upid):
+    # "status" is "running" or "stopped", a stopped task has an "exitstatus" of "OK", "WARNINGS: n" or the error message
+    json = get(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/tasks/{upid}/status")
+    return json["data"]
+
+def get_task_log(upid, start):
+    # Lines after line number start as (number, text), line numbers start at 1
+    json = get(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/tasks/{upid}/log", params = { "start": start, "limit": 500 })
+    lines = [(line["n"], line["t"]) for line in json["data"]]
+    # An empty log is returned as a single placeholder line
+    if start == 0 and lines == [(1, "no content")]:
+        return []
+    return lines
+
+# Waits for any number of VM states and tasks in one polling loop
+# VM states are read with a single request for all VMs, tasks by their status, the new lines of their logs are printed as progress
+# The interval starts short and backs off with jitter while nothing changes, every change resets it
+class WaitEngine:
+    def __init__(self):
+        # vmid -> desired status
+        self.statuses = {}
+        self.current_statuses = {}
+        # upid -> number of log lines read
+        self.tasks = {}
+
+    def add_status(self, vmid, desired_status):
+        log("PVE", f"Waiting for VM {vmid} to be in \"{desired_status}\" state...")
+        self.statuses[str(vmid)] = desired_status
+
+    def add_task(self, upid):
+        self.tasks[upid] = 0
+
+    def poll_statuses(self):
+        changed = False
+        statuses = get_vm_statuses()
+        for vmid, desired_status in list(self.statuses.items()):
+            status = statuses.get(vmid)
+            if status != self.current_statuses.get(vmid):
+                log("PVE", f"VM {vmid} status: {status}")
+                self.current_statuses[vmid] = status
+                changed = True
+            if status == desired_status:
+                del self.statuses[vmid]
+        return changed
+
+    def poll_task(self, upid):
+        # The status is read before the log, so the log of a stopped task is complete
+        status = get_task_status(upid)
+        lines = get_task_log(upid, self.tasks[upid])
+        for n, line in lines:
+            log("TASK", line)
+            self.tasks[upid] = n
+        if status["status"] == "running":
+            return len(lines) > 0
+
+        del self.tasks[upid]
+        exit_status = status.get("exitstatus", "")
+        if exit_status == "OK" or exit_status.startswith("WARNINGS"):
+            log("PVE", "Task completed successfully.")
+            return True
+        raise Exception(f"Task failed: {exit_status or 'unknown exit status'}")
+
+    def run(self, timeout = None):
+        start_time = time.time()
+        interval = MIN_WAIT_INTERVAL
+        while True:
+            changed = False
+            if self.statuses:
+                changed = self.poll_statuses()
+            for upid in list(self.tasks):
+                changed = self.poll_task(upid) or changed
+            if not self.statuses and not self.tasks:
                 return
-            else:
-                raise Exception(f"Restore failed: {exitstatus}")
-        log("PVE", f"Current status: {status}")
-        time.sleep(interval)
+
+            if timeout and time.time() - start_time > timeout:
+                raise TimeoutError(f"Timeout while waiting for VMs {list(self.statuses)} and tasks {list(self.tasks)}")
+            interval = MIN_WAIT_INTERVAL if changed else min(MAX_WAIT_INTERVAL, interval * 2)
+            time.sleep(interval * random.uniform(0.8, 1.2))
 
 def restore_vm_backup_by_filename(vmid, backup_storage, file):
     restore_vm_backup(vmid, f"{backup_storage}:backup/{file}")
@@ -87,3 +207,23 @@ def restore_vm_backup(vmid, volid):
     
     log("PVE", f"Restore started. Waiting for a completion...")
     wait_for_task_completion(resp["data"])
+
+def rollback_vm_snapshot(vmid, snapshot):
+    # Only reverts the changed blocks of the disks, a snapshot including the RAM resumes the VM in the running state
+    log("PVE", f"Rolling back VM {vmid} to snapshot {snapshot}...")
+    resp = post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}/snapshot/{snapshot}/rollback")
+    wait_for_task_completion(resp["data"])
+
+def destroy_vm(vmid):
+    log("PVE", f"Destroying VM {vmid}...")
+    resp = delete(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{vmid}", params = { "purge": 1 })
+    wait_for_task_completion(resp["data"])
+
+def clone_vm(template_vmid, vmid):
+    # A linked clone only references the disks of the template, so it is created in seconds
+    log("PVE", f"Creating VM {vmid} as linked clone of template {template_vmid}...")
+    resp = post(f"{PROXMOX_HOST}/api2/json/nodes/{NODE}/qemu/{template_vmid}/clone", data = {
+        "newid": vmid,
+        "full": 0
+    })
+    wait_for_task_completion(resp["data"])
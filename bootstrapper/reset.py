@@ -0,0 +1,61 @@
+import time
+import config
+import proxmox_vm
+from log import *
+from contextlib import contextmanager
+
+# backup: restore the latest vzdump backup (or PVE_RUNNER_BACKUP), rewrites the whole disk
+# snapshot: roll back to the snapshot PVE_RUNNER_SNAPSHOT of the VM
+# clone: destroy the VM and create it again as linked clone of the template PVE_RUNNER_TEMPLATE
+# The backup restore is the fallback if another mode fails
+RESET_BACKUP = "backup"
+RESET_SNAPSHOT = "snapshot"
+RESET_CLONE = "clone"
+RESET_MODES = [RESET_BACKUP, RESET_SNAPSHOT, RESET_CLONE]
+
+@contextmanager
+def phase(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        log("BOOTSTRAPPER", f"{name} took {time.time() - start:.1f}s")
+
+def restore_backup(vmid):
+    # Restore the VM from the latest backup to ensure a clean state
+    backup_volid = config.RUNNER_BACKUP or proxmox_vm.get_latest_backup_filename(vmid, config.BACKUP_STORAGE)
+    if backup_volid is None:
+        log("BOOTSTRAPPER", "No backup found, exiting...")
+        exit(1)
+    proxmox_vm.restore_vm_backup(vmid, backup_volid)
+
+def reset_vm(vmid, mode):
+    if mode == RESET_SNAPSHOT:
+        if not config.RUNNER_SNAPSHOT:
+            raise ValueError("PVE_RUNNER_SNAPSHOT is not set")
+        proxmox_vm.rollback_vm_snapshot(vmid, config.RUNNER_SNAPSHOT)
+    elif mode == RESET_CLONE:
+        if not config.RUNNER_TEMPLATE:
+            raise ValueError("PVE_RUNNER_TEMPLATE is not set")
+        if vmid in proxmox_vm.get_vm_statuses():
+            proxmox_vm.destroy_vm(vmid)
+        proxmox_vm.clone_vm(config.RUNNER_TEMPLATE, vmid)
+    else:
+        restore_backup(vmid)
+
+def reset_and_start(vmid, mode, reset = True):
+    if reset:
+        with phase(f"Reset ({mode})"):
+            try:
+                reset_vm(vmid, mode)
+            except Exception as e:
+                if mode == RESET_BACKUP:
+                    raise
+                log("BOOTSTRAPPER", f"Reset ({mode}) failed, falling back to the backup restore: {e}")
+                restore_backup(vmid)
+
+    # Start the VM, a rollback to a snapshot with RAM already resumed it
+    with phase("Start"):
+        if proxmox_vm.get_vm_status(vmid) != "running":
+            proxmox_vm.start_vm(vmid)
+            proxmox_vm.wait_vm_status(vmid, "running")
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import time
+from log import *
+
+# The lock file of the cache action is shared, its directory is appended so the modules of the bootstrapper take precedence
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache"))
+from filelock import LockFile
+
+STANDBY_FILE = ".standby.json"
+STANDBY_LOCK = ".standby.lock"
+
+# Runner VMs which were reset and started ahead of time by a prepare process, vmid -> time they became ready
+# A bootstrapper claims a ready VM instead of resetting one, the file is only accessed while holding its lock
+class Standby:
+    def __init__(self, path):
+        self.file_path = os.path.join(path, STANDBY_FILE)
+        self.lock_path = os.path.join(path, STANDBY_LOCK)
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            log("STANDBY", f"Failed to load {self.file_path}: {e}")
+            return {}
+
+    def save(self, entries):
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.file_path)
+
+    def count(self):
+        with LockFile(self.lock_path, wait_interval = None):
+            return len(self.load())
+
+    def add(self, vmid):
+        with LockFile(self.lock_path, wait_interval = None):
+            entries = self.load()
+            entries[vmid] = time.time()
+            self.save(entries)
+
+    def claim(self, statuses):
+        # Returns the longest waiting VM which is still running or None
+        # VMs which stopped were used by a job without a bootstrapper or shut down, they are dropped
+        with LockFile(self.lock_path, wait_interval = None):
+            entries = self.load()
+            if not entries:
+                return None
+            claimed = None
+            for vmid in sorted(entries, key = entries.get):
+                del entries[vmid]
+                if statuses.get(vmid) == "running":
+                    claimed = vmid
+                    break
+                log("STANDBY", f"Prepared VM {vmid} is not running anymore")
+            self.save(entries)
+            return claimed
@@ -1,38 +1,123 @@
 import os
+import sys
+import time
+import subprocess
 import config
 from log import *
-from filelock import LockFile
 
 LOCK_TIMEOUT = 3600
 
 BOOTSTRAPPER_PATH_VAR = os.getenv("INPUT_BOOTSTRAPPER_PATH")
 BOOTSTRAPPER_PATH = os.path.abspath(os.path.join(os.getcwd(), BOOTSTRAPPER_PATH_VAR))
 ENV_FILE_PATH = os.path.join(BOOTSTRAPPER_PATH, ".env")
-LOCK_FILE_PATH = os.path.join(BOOTSTRAPPER_PATH, ".lock")
 RESET_RUNNER = os.getenv("INPUT_RESET_RUNNER", "true").lower() == "true"
+RESET_MODE = (os.getenv("INPUT_RESET_MODE") or "backup").lower()
+PREPARE_NEXT = os.getenv("INPUT_PREPARE_NEXT", "false").lower() == "true"
+PREPARE_LOCK_PATH = os.path.join(BOOTSTRAPPER_PATH, ".prepare.lock")
+PREPARE_LOG_PATH = os.path.join(BOOTSTRAPPER_PATH, "prepare.log")
+STANDBY_COUNT = 1
+PREPARE_STARTED = "Started preparing the next runner VM"
 
 log("BOOTSTRAPPER", f"Loading config: {ENV_FILE_PATH}")
 config.initialize(ENV_FILE_PATH)
 
 import proxmox_vm
+from reset import RESET_MODES, phase, reset_and_start
+from pool import RunnerPool, POLL_INTERVAL
+from standby import Standby
+from filelock import LockFile
+
+if RESET_MODE not in RESET_MODES:
+    raise ValueError(f"Unknown reset mode: {RESET_MODE}")
+
+def set_output(name, value):
+    output_file = os.getenv("GITHUB_OUTPUT")
+    if output_file:
+        with open(output_file, "a") as f:
+            f.write(f"{name}={value}\n")
+
+def spawn_prepare():
+    # The process outlives the job, RUNNER_TRACKING_ID is cleared so the runner doesn't kill it as an orphan
+    # The action removes its checkout after this step, so the process reports back once all modules are loaded
+    env = dict(os.environ, RUNNER_TRACKING_ID = "")
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "prepare"],
+        stdin = subprocess.DEVNULL,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.STDOUT,
+        text = True,
+        env = env,
+        start_new_session = True
+    )
+    for line in process.stdout:
+        if line.startswith(PREPARE_STARTED):
+            break
+        print(line, end = "")
+    log("BOOTSTRAPPER", f"{PREPARE_STARTED}, logging to {PREPARE_LOG_PATH}")
+    process.stdout.close()
+
+def prepare():
+    # Resets and starts the next idle VM in the background, so the next bootstrapper finds a running VM
+    print(PREPARE_STARTED, flush = True)
+    log_file = open(PREPARE_LOG_PATH, "a")
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    os.dup2(log_file.fileno(), sys.stderr.fileno())
+
+    prepare_lock = LockFile(PREPARE_LOCK_PATH)
+    if not prepare_lock.try_acquire():
+        log("BOOTSTRAPPER", "Another process is already preparing a VM")
+        return
+    try:
+        standby = Standby(BOOTSTRAPPER_PATH)
+        if standby.count() >= STANDBY_COUNT:
+            log("BOOTSTRAPPER", "A prepared VM is already waiting")
+            return
+
+        # Doesn't enter the queue of the pool, waiting bootstrappers can take the VM first
+        pool = RunnerPool(BOOTSTRAPPER_PATH, config.RUNNER_VMIDS)
+        deadline = time.time() + LOCK_TIMEOUT
+        while (lease := pool.try_lease(proxmox_vm.get_vm_statuses())) is None:
+            if time.time() > deadline:
+                log("BOOTSTRAPPER", "No runner VM became idle to prepare")
+                return
+            time.sleep(POLL_INTERVAL)
+
+        vmid, vm_lock = lease
+        try:
+            log("BOOTSTRAPPER", f"Preparing VM {vmid}")
+            reset_and_start(vmid, RESET_MODE, RESET_RUNNER)
+            # Added before the VM lock is released, so it is never seen as busy instead of prepared
+            standby.add(vmid)
+            log("BOOTSTRAPPER", f"VM {vmid} is prepared")
+        finally:
+            vm_lock.release()
+    finally:
+        prepare_lock.release()
+
+def start():
+    with phase("Lease"):
+        log("BOOTSTRAPPER", "Leasing runner VM...")
+        # The lease guarantees that the VM is stopped, otherwise it is currently running a workflow
+        vmid, vm_lock = RunnerPool(BOOTSTRAPPER_PATH, config.RUNNER_VMIDS, Standby(BOOTSTRAPPER_PATH)).lease(LOCK_TIMEOUT)
+    set_output("vmid", vmid)
+
+    # Prepared in the background while this VM is reset and runs its job
+    if PREPARE_NEXT:
+        spawn_prepare()
+
+    if vm_lock is None:
+        log("BOOTSTRAPPER", f"VM {vmid} was prepared ahead of time and is running")
+        return
+    try:
+        reset_and_start(vmid, RESET_MODE, RESET_RUNNER)
+    finally:
+        vm_lock.release()
 
-try:
-    log("BOOTSTRAPPER", "Acquiring lock...")
-    with LockFile(LOCK_FILE_PATH, timeout = LOCK_TIMEOUT):
-        # Wait for the VM to be stopped, otherwise it is currently running a workflow
-        proxmox_vm.wait_vm_status(config.RUNNER_VMID, "stopped")
-
-        # Restore the VM from the latest backup to ensure a clean state
-        if RESET_RUNNER:
-            backup_volid = config.RUNNER_BACKUP or proxmox_vm.get_latest_backup_filename(config.RUNNER_VMID, config.BACKUP_STORAGE)
-            if backup_volid is None:
-                log("BOOTSTRAPPER", "No backup found, exiting...")
-                exit(1)
-            proxmox_vm.restore_vm_backup(config.RUNNER_VMID, backup_volid)
-
-        # Start the VM
-        proxmox_vm.start_vm(config.RUNNER_VMID)
-        proxmox_vm.wait_vm_status(config.RUNNER_VMID, "running")
-except TimeoutError as e:
-    log("BOOTSTRAPPER", str(e))
-    raise e
+if len(sys.argv) > 1 and sys.argv[1] == "prepare":
+    prepare()
+else:
+    try:
+        start()
+    except TimeoutError as e:
+        log("BOOTSTRAPPER", str(e))
+        raise e
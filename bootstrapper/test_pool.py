@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import config
+from fake_proxmox import FakeProxmox, FakeProxmoxServer
+
+# Runs the runner pool against the fake Proxmox API: python -m unittest discover bootstrapper
+
+NODE = "pve"
+VMIDS = ["101", "102"]
+
+os.environ.update(
+    PVE_NODE = NODE,
+    PVE_API_USER = "test@pve!token",
+    PVE_API_TOKEN = "secret"
+)
+config.initialize(os.devnull)
+import proxmox_vm
+import pool
+from pool import RunnerPool
+
+class RunnerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeProxmox(NODE, VMIDS)
+        self.server = FakeProxmoxServer(self.fake).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        for target, name, value in [(proxmox_vm, "PROXMOX_HOST", self.server.url), (pool, "POLL_INTERVAL", 0.05)]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.pool = RunnerPool(directory.name, VMIDS)
+
+    def lease(self, timeout = 5):
+        vmid, lock = self.pool.lease(timeout)
+        self.addCleanup(lock.release)
+        return vmid
+
+    def test_try_lease_skips_locked_vms(self):
+        first = self.pool.try_lease({})
+        self.addCleanup(first[1].release)
+        second = self.pool.try_lease({})
+        self.addCleanup(second[1].release)
+        self.assertEqual([first[0], second[0]], VMIDS)
+        self.assertIsNone(self.pool.try_lease({}))
+
+    def test_try_lease_skips_busy_vms(self):
+        self.fake.set_status("101", "running")
+        vmid, lock = self.pool.try_lease(proxmox_vm.get_vm_statuses())
+        lock.release()
+        self.assertEqual(vmid, "102")
+
+    def test_try_lease_rechecks_status(self):
+        # The statuses were read before another bootstrapper started both VMs and released their locks
+        statuses = proxmox_vm.get_vm_statuses()
+        for vmid in VMIDS:
+            self.fake.set_status(vmid, "running")
+        self.assertIsNone(self.pool.try_lease(statuses))
+        for vmid in VMIDS:
+            lock = self.pool.vm_lock_path(vmid)
+            self.assertTrue(pool.LockFile(lock).try_acquire())
+
+    def test_try_lease_missing_vm_is_idle(self):
+        with self.fake.lock:
+            del self.fake.vms["101"]
+        vmid, lock = self.pool.try_lease(proxmox_vm.get_vm_statuses())
+        lock.release()
+        self.assertEqual(vmid, "101")
+
+    def test_concurrent_leases_are_distinct(self):
+        leases = []
+        threads = [threading.Thread(target = lambda: leases.append(self.lease())) for _ in VMIDS]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(leases), VMIDS)
+
+    def test_lease_times_out_while_all_vms_are_leased(self):
+        for _ in VMIDS:
+            self.lease()
+        with self.assertRaises(TimeoutError):
+            self.pool.lease(0.2)
+
+    def test_lease_waits_for_released_vm(self):
+        vmid = self.pool.try_lease({})
+        other = self.pool.try_lease({})
+        self.addCleanup(other[1].release)
+        timer = threading.Timer(0.2, vmid[1].release)
+        timer.start()
+        self.addCleanup(timer.join)
+        self.assertEqual(self.lease(), vmid[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import time
+import unittest
+from unittest import mock
+import requests
+import config
+from fake_proxmox import FakeProxmox, FakeProxmoxServer
+
+# Runs the API client against the fake Proxmox API: python -m unittest discover bootstrapper
+
+NODE = "pve"
+DURATIONS = { task_type: 0.2 for task_type in ["qmrestore", "qmrollback", "qmclone", "qmdestroy", "qmstart", "qmstop", "qmshutdown"] }
+
+os.environ.update(
+    PVE_NODE = NODE,
+    PVE_API_USER = "test@pve!token",
+    PVE_API_TOKEN = "secret"
+)
+config.initialize(os.devnull)
+import proxmox_vm
+
+class ProxmoxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeProxmox(NODE, ["101"], durations = DURATIONS)
+        self.server = FakeProxmoxServer(self.fake).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        for name, value in [("PROXMOX_HOST", self.server.url), ("MIN_WAIT_INTERVAL", 0.05), ("backoff", lambda attempt: 0)]:
+            patcher = mock.patch.object(proxmox_vm, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add_task(self, task_type, vmid, error = None, silent = False):
+        with self.fake.lock:
+            return self.fake.add_task(task_type, vmid, error, silent)
+
+class WaitEngineTest(ProxmoxTestCase):
+    def test_task_completes_by_status(self):
+        upid = proxmox_vm.start_vm("101")
+        proxmox_vm.wait_for_task_completion(upid, timeout = 10)
+        self.assertEqual(proxmox_vm.get_vm_status("101"), "running")
+
+    def test_failed_task_raises(self):
+        upid = self.add_task("qmrollback", "101", error = "VM is running")
+        with self.assertRaisesRegex(Exception, "VM is running"):
+            proxmox_vm.wait_for_task_completion(upid, timeout = 10)
+
+    def test_task_stops_without_task_line(self):
+        upid = self.add_task("qmstart", "101", silent = True)
+        proxmox_vm.wait_for_task_completion(upid, timeout = 10)
+        self.assertEqual(proxmox_vm.get_task_status(upid)["exitstatus"], "OK")
+
+    def test_silent_failed_task_raises(self):
+        upid = self.add_task("qmstart", "101", error = "unexpected status", silent = True)
+        with self.assertRaisesRegex(Exception, "unexpected status"):
+            proxmox_vm.wait_for_task_completion(upid, timeout = 10)
+
+    def test_tasks_and_statuses_together(self):
+        upids = [proxmox_vm.start_vm("101"), self.add_task("qmstart", "101", silent = True)]
+        engine = proxmox_vm.WaitEngine()
+        for upid in upids:
+            engine.add_task(upid)
+        engine.add_status("101", "running")
+        engine.run(timeout = 10)
+        self.assertEqual(engine.tasks, {})
+        self.assertEqual(engine.statuses, {})
+
+class TaskLogTest(ProxmoxTestCase):
+    def test_empty_log_placeholder(self):
+        upid = self.add_task("qmstart", "101", silent = True)
+        json = proxmox_vm.get(f"{self.server.url}/api2/json/nodes/{NODE}/tasks/{upid}/log")
+        self.assertEqual(json["data"], [{ "n": 1, "t": "no content" }])
+        self.assertEqual(proxmox_vm.get_task_log(upid, 0), [])
+
+    def test_log_lines_after_start(self):
+        upid = proxmox_vm.start_vm("101")
+        proxmox_vm.wait_for_task_completion(upid, timeout = 10)
+        lines = proxmox_vm.get_task_log(upid, 0)
+        self.assertEqual(lines[0], (1, "qmstart VM 101"))
+        self.assertEqual(lines[-1][1], "TASK OK")
+        self.assertEqual(proxmox_vm.get_task_log(upid, 1), lines[1:])
+        self.assertEqual(proxmox_vm.get_task_log(upid, len(lines)), [])
+
+class RetryTest(ProxmoxTestCase):
+    def test_get_retried_on_error_status(self):
+        self.fake.failure_rate = 1.0
+        with self.assertRaises(requests.HTTPError):
+            proxmox_vm.get_vm_statuses()
+        self.assertEqual(self.fake.requests, proxmox_vm.RETRIES + 1)
+
+    def test_post_not_retried_on_error_status(self):
+        # The fake only fails GET requests by itself
+        with mock.patch.object(self.fake, "handle", return_value = (503, None)) as handle:
+            with self.assertRaises(requests.HTTPError):
+                proxmox_vm.start_vm("101")
+        self.assertEqual(handle.call_count, 1)
+
+    def test_delete_not_retried_on_error_status(self):
+        with mock.patch.object(self.fake, "handle", return_value = (503, None)) as handle:
+            with self.assertRaises(requests.HTTPError):
+                proxmox_vm.delete(f"{self.server.url}/api2/json/nodes/{NODE}/qemu/101")
+        self.assertEqual(handle.call_count, 1)
+
+    def test_post_not_retried_on_read_timeout(self):
+        with mock.patch.object(proxmox_vm, "REQUEST_TIMEOUT", 0.2), mock.patch.object(self.fake, "handle", side_effect = slow(self.fake.handle, 0.5)):
+            with self.assertRaises(requests.ReadTimeout):
+                proxmox_vm.start_vm("101")
+        self.assertEqual(self.fake.requests, 1)
+
+    def test_post_retried_if_unsent(self):
+        # Nothing listens on the port of the stopped server, so the connection is refused before anything was sent
+        self.server.__exit__(None, None, None)
+        with mock.patch.object(proxmox_vm, "RETRIES", 2), mock.patch.object(proxmox_vm.SESSION, "request", wraps = proxmox_vm.SESSION.request) as session_request:
+            with self.assertRaises(requests.ConnectionError):
+                proxmox_vm.start_vm("101")
+        self.assertEqual(session_request.call_count, 3)
+
+def slow(handle, seconds):
+    def slow_handle(*args):
+        result = handle(*args)
+        time.sleep(seconds)
+        return result
+    return slow_handle
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,15 @@
 import subprocess
 import os
+import re
+import time
 import shutil
 
 UNITY_PATH_VAR = os.getenv("INPUT_UNITY_PATH_VAR")
 UNITY_PATH = os.getenv(UNITY_PATH_VAR)
 PROJECT_PATH = os.getenv("INPUT_PROJECT_PATH")
 OUTPUT_PATH = os.getenv("INPUT_OUTPUT_PATH")
-PLATFORM = os.getenv("INPUT_PLATFORM")
+# Several platforms (comma or newline separated) are built in one editor session, each into a subfolder of the output path
+PLATFORMS = list(dict.fromkeys(platform.strip() for platform in re.split("[,\n]", os.getenv("INPUT_PLATFORM", "")) if platform.strip()))
 EXECUTE_METHOD = os.getenv("INPUT_EXECUTE_METHOD", "JNI.Editor.CI.CIBuild.Build")
 IL2CPP = os.getenv("INPUT_IL2CPP", "false")
 IL2CPP_COMPILER_CONFIG = os.getenv("INPUT_IL2CPP_COMPILER_CONFIG", "master").lower()
@@ -15,7 +18,8 @@ assert(UNITY_PATH_VAR)
 assert(UNITY_PATH)
 assert(PROJECT_PATH)
 assert(OUTPUT_PATH)
-assert(PLATFORM in ["StandaloneWindows64", "StandaloneWindows", "StandaloneLinux64"])
+assert(PLATFORMS)
+assert(all(platform in ["StandaloneWindows64", "StandaloneWindows", "StandaloneLinux64"] for platform in PLATFORMS))
 if IL2CPP_COMPILER_CONFIG:
     assert(IL2CPP_COMPILER_CONFIG in ["master", "release", "debug"])
 
@@ -30,8 +34,8 @@ args = [
     "-logfile", "-",
     "-projectPath", PROJECT_PATH,
     "-executeMethod", EXECUTE_METHOD,
-    "-unityBuildTarget", PLATFORM,
-    "-target", PLATFORM,
+    "-unityBuildTarget", PLATFORMS[0],
+    "-target", ",".join(PLATFORMS),
     "-il2cpp", IL2CPP,
     "-il2cppCompilerConfiguration", IL2CPP_COMPILER_CONFIG,
     "-output", OUTPUT_PATH
@@ -41,7 +45,9 @@ if os.path.exists(OUTPUT_PATH):
     print(f"Deleting existing output directory: {OUTPUT_PATH}")
     shutil.rmtree(OUTPUT_PATH)
 
-print("Starting Unity build...")
+print(f"Starting Unity build for {', '.join(PLATFORMS)}...")
+start_time = time.time()
+startup_time = None
 process = subprocess.Popen(
     args,
     stdout = subprocess.PIPE,
@@ -51,9 +57,14 @@ process = subprocess.Popen(
 )
 
 for line in process.stdout:
+    # The editor is loaded once the build method starts
+    if startup_time is None and "[CIBuild] Starting build" in line:
+        startup_time = time.time() - start_time
     print(line, end = "")
 
 process.wait()
+if startup_time is not None:
+    print(f"\nEditor startup took {startup_time:.1f}s, total {time.time() - start_time:.1f}s")
 
 print(f"\n{"[SUCCESS]" if process.returncode == 0 else "[ERROR]"} Unity exited with code {process.returncode}")
 exit(process.returncode)
@@ -1,5 +1,6 @@
 using System;
 using System.Collections.Generic;
+using System.Diagnostics;
 using System.IO;
 using System.Linq;
 using UnityEditor;
@@ -31,16 +32,36 @@ namespace JNI.Editor.CI
                 }
             }
 
-            BuildData data = new BuildData();
-            if(parsedArgs.TryGetValue(targetArg, out string targetStr) == false || targetStr == null || Enum.TryParse(targetStr, out BuildTarget target) == false)
+            //Multiple targets are separated by commas and built one after another in this editor session
+            List<BuildTarget> targets = new List<BuildTarget>();
+            if(parsedArgs.TryGetValue(targetArg, out string targetStr) == false || targetStr == null)
             {
-                Log($"Argument {targetArg} is missing or invalid!");
+                Log($"Argument {targetArg} is missing!");
                 EditorApplication.Exit(1);
                 return;
             }
-            if(target != BuildTarget.StandaloneWindows && target != BuildTarget.StandaloneWindows64 && target != BuildTarget.StandaloneLinux64)
+            foreach(string targetName in targetStr.Split(',').Select(n => n.Trim()).Where(n => n.Length > 0))
             {
-                Log($"Platform {target} is not supported!");
+                if(Enum.TryParse(targetName, out BuildTarget target) == false)
+                {
+                    Log($"Argument {targetArg} is invalid ({targetName})!");
+                    EditorApplication.Exit(1);
+                    return;
+                }
+                if(target != BuildTarget.StandaloneWindows && target != BuildTarget.StandaloneWindows64 && target != BuildTarget.StandaloneLinux64)
+                {
+                    Log($"Platform {target} is not supported!");
+                    EditorApplication.Exit(1);
+                    return;
+                }
+                if(targets.Contains(target) == false)
+                {
+                    targets.Add(target);
+                }
+            }
+            if(targets.Count == 0)
+            {
+                Log($"Argument {targetArg} is missing!");
                 EditorApplication.Exit(1);
                 return;
             }
@@ -51,23 +72,50 @@ namespace JNI.Editor.CI
                 return;
             }
 
-            data.Target = target;
-            data.IL2CPP = parsedArgs.TryGetValue(il2cppArg, out string il2cppString) && il2cppString?.ToLower() == "true";
-            data.IL2CPPConfig = parsedArgs.GetValueOrDefault(il2cppConfigArg, "").ToLower() switch
+            bool il2cpp = parsedArgs.TryGetValue(il2cppArg, out string il2cppString) && il2cppString?.ToLower() == "true";
+            Il2CppCompilerConfiguration il2cppConfig = parsedArgs.GetValueOrDefault(il2cppConfigArg, "").ToLower() switch
             {
                 "master" => Il2CppCompilerConfiguration.Master,
                 "release" => Il2CppCompilerConfiguration.Release,
                 "debug" => Il2CppCompilerConfiguration.Debug,
                 _ => Il2CppCompilerConfiguration.Master
             };
-            data.OutputFolder = output;
-            string fileName = $"{Application.productName.Replace(" ", "")}{GetExtension(target)}";
-            Compile(data, fileName);
 
+            List<BuildTimings> timings = new List<BuildTimings>();
+            foreach(BuildTarget target in OrderTargets(targets, EditorUserBuildSettings.activeBuildTarget))
+            {
+                BuildData data = new BuildData();
+                data.Target = target;
+                data.IL2CPP = il2cpp;
+                data.IL2CPPConfig = il2cppConfig;
+                //A single target is built into the output folder itself, multiple targets into subfolders
+                data.OutputFolder = targets.Count > 1 ? Path.Combine(output, target.ToString()) : output;
+                string fileName = $"{Application.productName.Replace(" ", "")}{GetExtension(target)}";
+                BuildTimings targetTimings = new BuildTimings() { Target = target };
+                timings.Add(targetTimings);
+                if(Compile(data, fileName, targetTimings) == false)
+                {
+                    LogTimings(timings);
+                    EditorApplication.Exit(1);
+                    return;
+                }
+            }
+
+            LogTimings(timings);
             Log($"Completed build");
         }
 
-        private static void Compile(BuildData data, string fileName)
+        private static IEnumerable<BuildTarget> OrderTargets(List<BuildTarget> targets, BuildTarget activeTarget)
+        {
+            //The active target needs no switch, targets of the same OS share the import settings of plugins, so they follow each other
+            //All supported targets are in the standalone group, so switching between them doesn't reimport textures
+            return targets
+                .OrderBy(n => n == activeTarget ? 0 : 1)
+                .ThenBy(n => IsWindows(n) == IsWindows(activeTarget) ? 0 : 1)
+                .ThenBy(n => targets.IndexOf(n));
+        }
+
+        private static bool Compile(BuildData data, string fileName, BuildTimings timings)
         {
             Log($"Compile Params:\ntarget = {data.Target}\nil2cpp = {data.IL2CPP}\nil2cpp config = {data.IL2CPPConfig}\noutput = {data.OutputFolder}");
 
@@ -76,22 +124,29 @@ namespace JNI.Editor.CI
             Il2CppCompilerConfiguration prevCompilerConfig = UnityEditor.PlayerSettings.GetIl2CppCompilerConfiguration(namedTarget);
 
             string tmpDir = null;
+            Stopwatch stopwatch = Stopwatch.StartNew();
             try
             {
                 //Settings
                 Log($"Apply settings");
                 bool il2cpp = data.IL2CPP && IL2CPPSupported(data.Target);
-                EditorUserBuildSettings.SwitchActiveBuildTarget(BuildTargetGroup.Standalone, data.Target);
+                if(EditorUserBuildSettings.activeBuildTarget != data.Target)
+                {
+                    EditorUserBuildSettings.SwitchActiveBuildTarget(BuildTargetGroup.Standalone, data.Target);
+                }
                 UnityEditor.PlayerSettings.SetScriptingBackend(namedTarget, il2cpp ? ScriptingImplementation.IL2CPP : ScriptingImplementation.Mono2x);
                 if(il2cpp)
                 {
                     UnityEditor.PlayerSettings.SetIl2CppCompilerConfiguration(namedTarget, data.IL2CPPConfig);
                 }
                 string[] additionalDefines = new string[] { "STEAM_BUILD" };
+                timings.Switch = stopwatch.Elapsed.TotalSeconds;
+                stopwatch.Restart();
 
-                //Temporary build directory
+                //Temporary build directory next to the output folder, so it is on the same volume and can be moved into place
                 Log($"Create build directory");
-                tmpDir = Path.Combine(Path.GetTempPath(), Guid.NewGuid().ToString());
+                string outputFolder = Path.GetFullPath(data.OutputFolder).TrimEnd(Path.DirectorySeparatorChar, Path.AltDirectorySeparatorChar);
+                tmpDir = Path.Combine(Path.GetDirectoryName(outputFolder), $".{Path.GetFileName(outputFolder)}.{Guid.NewGuid()}");
                 Directory.CreateDirectory(tmpDir);
                 string tmpPath = Path.Combine(tmpDir, fileName);
 
@@ -105,41 +160,54 @@ namespace JNI.Editor.CI
                 options.options = BuildOptions.None;
                 options.extraScriptingDefines = additionalDefines;
                 UnityEditor.Build.Reporting.BuildReport report = BuildPipeline.BuildPlayer(options);
-                Log($"Build completed with result {report.summary.result} in {report.summary.totalTime.Seconds}s");
+                timings.Build = stopwatch.Elapsed.TotalSeconds;
+                stopwatch.Restart();
+                Log($"Build completed with result {report.summary.result} in {report.summary.totalTime.TotalSeconds:F0}s");
                 if(report.summary.result != UnityEditor.Build.Reporting.BuildResult.Succeeded)
                 {
-                    EditorApplication.Exit(1);
-                    return;
+                    return false;
                 }
 
-                //Copy
+                //Move
                 try
                 {
-                    Log($"Copy dir to destination {tmpDir} -> {data.OutputFolder}");
-                    CopyDirContents(tmpDir, data.OutputFolder);
-
-                    List<string> foldersToDelete = new List<string>();
-                    foreach(string d in Directory.GetDirectories(data.OutputFolder))
+                    foreach(string d in Directory.GetDirectories(tmpDir))
                     {
                         if(d.Contains("BackUpThisFolder") || d.EndsWith("_DoNotShip"))
                         {
-                            foldersToDelete.Add(d);
+                            Directory.Delete(d, true);
                         }
                     }
-                    foldersToDelete.ForEach(n => Directory.Delete(n, true));
+
+                    //Renaming the directory doesn't touch the files, existing output is merged by copying
+                    if(Directory.Exists(outputFolder) == false)
+                    {
+                        Log($"Move dir to destination {tmpDir} -> {outputFolder}");
+                        Directory.CreateDirectory(Path.GetDirectoryName(outputFolder));
+                        Directory.Move(tmpDir, outputFolder);
+                    }
+                    else
+                    {
+                        Log($"Copy dir to existing destination {tmpDir} -> {outputFolder}");
+                        CopyDirContents(tmpDir, outputFolder);
+                    }
+                    timings.Place = stopwatch.Elapsed.TotalSeconds;
                 }
                 catch(Exception e)
                 {
-                    Log($"Could not copy build to output folder {data.OutputFolder} ({e.Message})");
-                    EditorApplication.Exit(1);
-                    return;
+                    Log($"Could not move build to output folder {data.OutputFolder} ({e.Message})");
+                    return false;
                 }
+                return true;
             }
             finally
             {
                 try
                 {
-                    Directory.Delete(tmpDir, true);
+                    if(Directory.Exists(tmpDir))
+                    {
+                        Directory.Delete(tmpDir, true);
+                    }
                 }
                 catch
                 {
@@ -152,6 +220,18 @@ namespace JNI.Editor.CI
             }
         }
 
+        private static void LogTimings(List<BuildTimings> timings)
+        {
+            Log($"Timings (switch / build / place):");
+            foreach(BuildTimings n in timings)
+            {
+                Log($"{n.Target}: {n.Switch:F1}s / {n.Build:F1}s / {n.Place:F1}s");
+            }
+        }
+
+        private static bool IsWindows(BuildTarget target)
+            => target == BuildTarget.StandaloneWindows || target == BuildTarget.StandaloneWindows64;
+
         private static string GetExtension(BuildTarget target) => target switch
         {
             BuildTarget.StandaloneWindows => ".exe",
@@ -194,4 +274,12 @@ namespace JNI.Editor.CI
         public Il2CppCompilerConfiguration IL2CPPConfig { get; set; }
         public string OutputFolder { get; set; }
     }
+
+    public class BuildTimings
+    {
+        public BuildTarget Target { get; set; }
+        public double Switch { get; set; }
+        public double Build { get; set; }
+        public double Place { get; set; }
+    }
 }
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import logging
+import time
+import random
+import shutil
+import socket
+import tempfile
+import argparse
+import subprocess
+from contextlib import contextmanager
+
+from log import *
+from s3 import S3Client, HashIndex, LAYOUT_PREFIX, LAYOUT_CAS
+from metrics import Metrics
+from chunking import CHUNK_THRESHOLD
+from compression import COMPRESSION_LEVEL
+from minio import Minio
+
+# Times the cache engine against a local S3 server on a synthetic Unity Library
+# Starts a MinIO binary (--minio) or an in-process moto server, or uses an existing server (--server)
+# Results are written as JSON, --compare prints the difference to the results of a previous run
+
+ACCESS_KEY = "benchmark"
+SECRET_KEY = "benchmark-secret"
+BUCKET = "benchmark"
+
+SCENARIOS = ["cold upload", "warm upload", "full restore", "changed upload", "incremental restore", "clear existing"]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout = 30):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout = 1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Local S3 server did not start on port {port}")
+
+@contextmanager
+def local_server(args, work_dir):
+    # Yields (server, access key, secret key, secure)
+    if args.server:
+        yield (args.server, args.access_key, args.secret_key, args.secure)
+        return
+
+    port = free_port()
+    if args.minio:
+        env = dict(os.environ, MINIO_ROOT_USER = ACCESS_KEY, MINIO_ROOT_PASSWORD = SECRET_KEY)
+        process = subprocess.Popen([args.minio, "server", os.path.join(work_dir, "minio"), "--address", f"127.0.0.1:{port}", "--quiet"], env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            yield (f"127.0.0.1:{port}", ACCESS_KEY, SECRET_KEY, False)
+        finally:
+            process.terminate()
+            process.wait()
+        return
+
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        log("BENCHMARK", "Neither --server nor --minio is set and moto is not installed (pip install moto[server])")
+        sys.exit(1)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer("127.0.0.1", port, verbose = False)
+    server.start()
+    try:
+        wait_for_port(port)
+        yield (f"127.0.0.1:{port}", ACCESS_KEY, SECRET_KEY, False)
+    finally:
+        server.stop()
+
+def write_file(rng, path, size):
+    # Half random, half repetitive data, serialized assets are partially compressible
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, 1024 * 1024)
+            random_size = block // 2
+            f.write(rng.randbytes(random_size))
+            f.write(b"m_ObjectHideFlags: 0\n" * ((block - random_size) // 21 + 1))
+            remaining -= block
+        f.truncate(size)
+
+def generate_tree(rng, root, args):
+    # Library shaped tree: many tiny artifacts, some metadata, a few huge files
+    files = []
+    for _ in range(args.files):
+        name = "%032x" % rng.getrandbits(128)
+        size = int(min(rng.lognormvariate(8.5, 1.5), 4 * 1024 * 1024))
+        files.append((os.path.join(root, "Library", "Artifacts", name[:2], name), size))
+    for _ in range(args.files // 10):
+        name = "%032x" % rng.getrandbits(128)
+        files.append((os.path.join(root, "Library", "metadata", name[:2], f"{name}.info"), rng.randint(200, 2000)))
+    for i in range(args.large_files):
+        files.append((os.path.join(root, "Library", "Bee", f"large_{i}.bundle"), args.large_size * 1024 * 1024))
+
+    for path, size in files:
+        write_file(rng, path, size)
+    return [path for path, _ in files]
+
+def change_tree(rng, files, ratio):
+    # Rewrites small files and patches a few bytes in the middle of large files
+    for path in rng.sample(files, max(1, int(len(files) * ratio))):
+        size = os.path.getsize(path)
+        if size > 4 * 1024 * 1024:
+            with open(path, "r+b") as f:
+                f.seek(size // 2)
+                f.write(rng.randbytes(4096))
+        else:
+            write_file(rng, path, size)
+
+def remove_files(rng, files, ratio):
+    removed = set(rng.sample(files, max(1, int(len(files) * ratio))))
+    for path in removed:
+        os.remove(path)
+    return [path for path in files if path not in removed]
+
+def run_scenario(name, results, server, args, operation):
+    metrics = Metrics()
+    with S3Client(server[0], server[1], server[2], args.layout, secure = server[3], compression_level = COMPRESSION_LEVEL if args.compression else None, metrics = metrics) as s3:
+        start = time.time()
+        operation(s3)
+        seconds = time.time() - start
+    data = metrics.to_dict()
+    results[name] = {
+        "seconds": seconds,
+        "transfers": { transfer: { "objects": values["objects"], "bytes": values["bytes"] } for transfer, values in data["transfers"].items() },
+        "requests": sum(request["count"] for request in data["requests"].values()),
+        "retries": data["retries"],
+        "failures": data["failures"]
+    }
+    log("BENCHMARK", f"{name}: {seconds:.2f}s")
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix = "cache-benchmark-")
+    source = os.path.join(work_dir, "source")
+    target = os.path.join(work_dir, "target")
+    source_index = HashIndex(os.path.join(work_dir, "source.hashindex"))
+    target_index = HashIndex(os.path.join(work_dir, "target.hashindex"))
+    remote_prefix = f"benchmark-{int(time.time())}/"
+    options = {
+        "workers": args.workers,
+        "pack_threshold": args.pack_threshold if args.pack_small_files else 0,
+        "chunk_threshold": args.chunk_threshold if args.chunk_large_files else 0
+    }
+    results = {}
+
+    try:
+        log("BENCHMARK", f"Generating tree in {source}...")
+        files = generate_tree(rng, source, args)
+        file_count = len(files)
+        total_size = sum(os.path.getsize(path) for path in files)
+        log("BENCHMARK", f"Generated {len(files)} files, {total_size / 1024 / 1024:.1f} MiB")
+
+        with local_server(args, work_dir) as server:
+            client = Minio(server[0], access_key = server[1], secret_key = server[2], secure = server[3])
+            if not client.bucket_exists(args.bucket):
+                client.make_bucket(args.bucket)
+
+            upload = lambda s3: s3.upload_directory(source, args.bucket, remote_prefix, hash_index = source_index.load(), **options)
+            run_scenario("cold upload", results, server, args, upload)
+            run_scenario("warm upload", results, server, args, upload)
+            run_scenario("full restore", results, server, args, lambda s3: s3.download_directory(target, args.bucket, remote_prefix, args.workers, hash_index = target_index.load(), incremental = False))
+
+            change_tree(rng, files, args.change_ratio)
+            run_scenario("changed upload", results, server, args, upload)
+            run_scenario("incremental restore", results, server, args, lambda s3: s3.download_directory(target, args.bucket, remote_prefix, args.workers, hash_index = target_index.load(), incremental = True))
+
+            files = remove_files(rng, files, args.change_ratio)
+            def clear_existing(s3):
+                keys = upload(s3)
+                s3.delete_keys(args.bucket, remote_prefix, keys, workers = args.workers)
+            run_scenario("clear existing", results, server, args, clear_existing)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    return {
+        "config": {
+            "files": file_count,
+            "bytes": total_size,
+            "seed": args.seed,
+            "change_ratio": args.change_ratio,
+            "layout": args.layout,
+            "server": "existing" if args.server else "minio" if args.minio else "moto",
+            **options,
+            "compression": args.compression
+        },
+        "results": results
+    }
+
+def print_results(report, baseline = None):
+    log("BENCHMARK", f"{'Scenario':<22}{'Seconds':>10}{'Requests':>10}{'Baseline':>10}{'Change':>9}")
+    for name in SCENARIOS:
+        result = report["results"].get(name)
+        if result is None:
+            continue
+        line = f"{name:<22}{result['seconds']:>10.2f}{result['requests']:>10}"
+        previous = baseline["results"].get(name) if baseline else None
+        if previous:
+            change = (result["seconds"] - previous["seconds"]) / previous["seconds"] * 100 if previous["seconds"] else 0.0
+            line += f"{previous['seconds']:>10.2f}{change:>+8.1f}%"
+        log("BENCHMARK", line)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark of the cache engine against a local S3 server")
+    parser.add_argument("--server", help = "Existing S3 server (host:port) instead of a local one")
+    parser.add_argument("--access-key", default = os.getenv("INPUT_SERVER_ACCESS_KEY"))
+    parser.add_argument("--secret-key", default = os.getenv("INPUT_SERVER_SECRET_KEY"))
+    parser.add_argument("--secure", action = "store_true", help = "Use https for --server")
+    parser.add_argument("--minio", help = "Path of a MinIO server binary, moto is used otherwise")
+    parser.add_argument("--bucket", default = BUCKET)
+    parser.add_argument("--files", type = int, default = 5000, help = "Number of small artifact files")
+    parser.add_argument("--large-files", type = int, default = 2)
+    parser.add_argument("--large-size", type = int, default = 128, help = "Size of large files in MiB")
+    parser.add_argument("--change-ratio", type = float, default = 0.05, help = "Fraction of files changed and removed between runs")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--workers", type = int, default = 8)
+    parser.add_argument("--layout", default = LAYOUT_PREFIX, choices = [LAYOUT_PREFIX, LAYOUT_CAS])
+    parser.add_argument("--pack-small-files", action = "store_true")
+    parser.add_argument("--pack-threshold", type = int, default = 256 * 1024)
+    parser.add_argument("--chunk-large-files", action = "store_true")
+    parser.add_argument("--chunk-threshold", type = int, default = CHUNK_THRESHOLD)
+    parser.add_argument("--compression", action = "store_true")
+    parser.add_argument("--output", help = "Write the results as JSON to this file")
+    parser.add_argument("--compare", help = "JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            log("BENCHMARK", "The configuration of the baseline differs, the results might not be comparable")
+    print_results(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
+        log("BENCHMARK", f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
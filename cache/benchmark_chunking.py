@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from log import *
+from s3 import S3Client, LAYOUT_PREFIX
+from chunking import CHUNK_THRESHOLD
+
+# Compares whole file and chunked transfers of a large file that changes slightly between two uploads
+# Uses the same INPUT_* variables as cache.py, the size of the test file in MiB can be passed as argument
+SERVER = os.getenv("INPUT_SERVER")
+SERVER_ACCESS_KEY = os.getenv("INPUT_SERVER_ACCESS_KEY")
+SERVER_SECRET_KEY = os.getenv("INPUT_SERVER_SECRET_KEY")
+SERVER_BUCKET = os.getenv("INPUT_SERVER_BUCKET")
+LAYOUT = (os.getenv("INPUT_LAYOUT") or LAYOUT_PREFIX).lower()
+# Meant for a local server over plain HTTP, INPUT_SERVER_SECURE=true connects with TLS
+SECURE = os.getenv("INPUT_SERVER_SECURE", "false").lower() == "true"
+SIZE = int(sys.argv[1] if len(sys.argv) > 1 else 512) * 1024 * 1024
+
+assert(SERVER)
+assert(SERVER_ACCESS_KEY)
+assert(SERVER_SECRET_KEY)
+assert(SERVER_BUCKET)
+
+def write_random_file(path, size):
+    with open(path, "wb") as f:
+        for offset in range(0, size, 1024 * 1024):
+            f.write(os.urandom(min(1024 * 1024, size - offset)))
+
+def modify_file(path):
+    # Insert a few bytes in the middle and overwrite some near the end, which shifts all following data
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    data[len(data) // 2:len(data) // 2] = os.urandom(100)
+    data[-4096:-3072] = os.urandom(1024)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def timed(name, results, operation):
+    start = time.time()
+    operation()
+    results[name] = time.time() - start
+
+def run(s3, work_dir, mode, chunk_threshold):
+    source = os.path.join(work_dir, mode, "source")
+    target = os.path.join(work_dir, mode, "target")
+    os.makedirs(source)
+    write_random_file(os.path.join(source, "asset.bundle"), SIZE)
+    shutil.copytree(source, target)
+
+    remote_prefix = f"benchmark-chunking/{mode}/"
+    results = {}
+    timed("upload", results, lambda: s3.upload_directory(source, SERVER_BUCKET, remote_prefix, chunk_threshold = chunk_threshold))
+    modify_file(os.path.join(source, "asset.bundle"))
+    timed("upload changed", results, lambda: s3.upload_directory(source, SERVER_BUCKET, remote_prefix, chunk_threshold = chunk_threshold))
+    timed("restore changed", results, lambda: s3.download_directory(target, SERVER_BUCKET, remote_prefix, incremental = True))
+
+    with open(os.path.join(source, "asset.bundle"), "rb") as a, open(os.path.join(target, "asset.bundle"), "rb") as b:
+        if a.read() != b.read():
+            log("BENCHMARK", f"Restored file of {mode} does not match the source")
+
+    s3.delete_keys(SERVER_BUCKET, remote_prefix, [])
+    return results
+
+def benchmark():
+    work_dir = tempfile.mkdtemp()
+    try:
+        with S3Client(SERVER, SERVER_ACCESS_KEY, SERVER_SECRET_KEY, LAYOUT, secure = SECURE) as s3:
+            results = {
+                "whole file": run(s3, work_dir, "whole", 0),
+                "chunked": run(s3, work_dir, "chunked", min(CHUNK_THRESHOLD, SIZE))
+            }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    log("BENCHMARK", f"{SIZE // 1024 // 1024} MiB file, {LAYOUT} layout")
+    for mode, timings in results.items():
+        log("BENCHMARK", f"{mode}: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+if __name__ == "__main__":
+    benchmark()
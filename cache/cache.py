@@ -1,7 +1,11 @@
 import os
+import tempfile
 
 from log import *
-from s3 import S3Client
+from s3 import S3Client, HashIndex, LAYOUT_PREFIX, PART_SIZE, PART_WORKERS, MAX_WORKERS
+from compression import COMPRESSION_LEVEL
+from chunking import CHUNK_THRESHOLD
+from local_cache import LocalCache, LOCAL_CACHE_SIZE
 
 SERVER = os.getenv("INPUT_SERVER")
 SERVER_ACCESS_KEY = os.getenv("INPUT_SERVER_ACCESS_KEY")
@@ -11,8 +15,32 @@ ID = os.getenv("INPUT_ID")
 PATH = os.getenv("INPUT_PATH")
 CLEAR_EXISTING = os.getenv("INPUT_CLEAR_EXISTING", "false").lower() == "true"
 ACTION = os.getenv("INPUT_ACTION", "cache").lower()
+RESTORE_KEYS = [key.strip() for key in os.getenv("INPUT_RESTORE_KEYS", "").splitlines() if key.strip()]
+HASH_INDEX = os.getenv("INPUT_HASH_INDEX", "")
+INCREMENTAL = os.getenv("INPUT_INCREMENTAL", "false").lower() == "true"
+PRUNE = os.getenv("INPUT_PRUNE", "false").lower() == "true"
+PACK_SMALL_FILES = os.getenv("INPUT_PACK_SMALL_FILES", "false").lower() == "true"
+PACK_THRESHOLD = int(os.getenv("INPUT_PACK_THRESHOLD") or 256 * 1024)
+PACK_SIZE = int(os.getenv("INPUT_PACK_SIZE") or 64 * 1024 * 1024)
+LAYOUT = (os.getenv("INPUT_LAYOUT") or LAYOUT_PREFIX).lower()
+PART_SIZE = int(os.getenv("INPUT_PART_SIZE") or PART_SIZE)
+PART_CONCURRENCY = int(os.getenv("INPUT_PART_CONCURRENCY") or PART_WORKERS)
+WORKERS = int(os.getenv("INPUT_WORKERS") or 8)
+MAX_WORKERS = int(os.getenv("INPUT_MAX_WORKERS") or MAX_WORKERS)
+ADAPTIVE_CONCURRENCY = os.getenv("INPUT_ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+COMPRESSION = os.getenv("INPUT_COMPRESSION", "false").lower() == "true"
+COMPRESSION_LEVEL = int(os.getenv("INPUT_COMPRESSION_LEVEL") or COMPRESSION_LEVEL)
+CHUNK_LARGE_FILES = os.getenv("INPUT_CHUNK_LARGE_FILES", "false").lower() == "true"
+CHUNK_THRESHOLD = int(os.getenv("INPUT_CHUNK_THRESHOLD") or CHUNK_THRESHOLD)
+LOCAL_CACHE = os.getenv("INPUT_LOCAL_CACHE", "")
+LOCAL_CACHE_SIZE = int(os.getenv("INPUT_LOCAL_CACHE_SIZE") or LOCAL_CACHE_SIZE)
+METRICS_FILE = os.getenv("INPUT_METRICS_FILE") or os.path.join(os.getenv("RUNNER_TEMP") or tempfile.gettempdir(), f"cache-metrics-{ACTION}.json")
 
 PATH = os.path.abspath(os.path.join(os.getcwd(), PATH))
+if HASH_INDEX:
+    HASH_INDEX = os.path.abspath(os.path.join(os.getcwd(), HASH_INDEX))
+else:
+    HASH_INDEX = os.path.join(os.path.dirname(PATH), f".{os.path.basename(PATH)}.hashindex")
 
 assert(SERVER)
 assert(SERVER_ACCESS_KEY)
@@ -21,38 +49,82 @@ assert(SERVER_BUCKET)
 assert(ID)
 assert(PATH)
 
+def progress(message):
+    # total is None while the files are still being enumerated
+    def callback(processed, total):
+        if total is None:
+            log("CACHE", f"{message} {processed} files")
+        else:
+            log("CACHE", f"{message} {processed / float(total) * 100.0 if total else 100.0:.1f}%")
+    return callback
+
+def set_output(name, value):
+    output_file = os.getenv("GITHUB_OUTPUT")
+    if output_file:
+        with open(output_file, "a") as f:
+            f.write(f"{name}={value}\n")
+
+def report_metrics(metrics, title):
+    # JSON for comparing runs and a table in the summary of the job
+    metrics.write(METRICS_FILE)
+    set_output("metrics-file", METRICS_FILE)
+    log("CACHE", f"Metrics written to {METRICS_FILE}")
+    summary_file = os.getenv("GITHUB_STEP_SUMMARY")
+    if summary_file:
+        metrics.write_summary(summary_file, title)
+
 def cache():
     if not os.path.exists(PATH):
         log("CACHE", f"The specified path directory does not exist: {PATH}... Skipping cache")
         return
 
-    with S3Client(SERVER, SERVER_ACCESS_KEY, SERVER_SECRET_KEY) as s3:
+    with S3Client(SERVER, SERVER_ACCESS_KEY, SERVER_SECRET_KEY, LAYOUT, PART_SIZE, PART_CONCURRENCY, max(WORKERS, MAX_WORKERS) * PART_CONCURRENCY, COMPRESSION_LEVEL if COMPRESSION else None) as s3:
         remote_prefix = s3.normalize_path(ID)
         if not remote_prefix.endswith("/"):
             remote_prefix += "/"
 
         log("CACHE", f"Cache local directory {PATH} to remote path {SERVER_BUCKET}/{remote_prefix}")
-        keys = s3.upload_directory(PATH, SERVER_BUCKET, remote_prefix, 8, lambda p: log("CACHE", f"Uploading to cache {p:.1f}%"))
+        hash_index = HashIndex(HASH_INDEX).load()
+        keys = s3.upload_directory(PATH, SERVER_BUCKET, remote_prefix, WORKERS, progress("Uploading to cache"), hash_index = hash_index, pack_threshold = PACK_THRESHOLD if PACK_SMALL_FILES else 0, pack_size = PACK_SIZE, max_workers = MAX_WORKERS, adaptive = ADAPTIVE_CONCURRENCY, chunk_threshold = CHUNK_THRESHOLD if CHUNK_LARGE_FILES else 0)
 
         if CLEAR_EXISTING:
             log("CACHE", f"Clear unused files in remote path {SERVER_BUCKET}/{remote_prefix}")
-            s3.delete_keys(SERVER_BUCKET, remote_prefix, keys, lambda p: log("CACHE", f"Deleting unused files {p:.1f}%"))
+            s3.delete_keys(SERVER_BUCKET, remote_prefix, keys, progress("Deleting unused files"), workers = WORKERS)
+
+        if keys is not None:
+            s3.update_index(SERVER_BUCKET, remote_prefix)
+        report_metrics(s3.metrics, f"Cache {SERVER_BUCKET}/{remote_prefix}")
 
 def restore():
     if not os.path.exists(PATH):
         os.makedirs(PATH)
 
-    with S3Client(SERVER, SERVER_ACCESS_KEY, SERVER_SECRET_KEY) as s3:
+    local_cache = LocalCache(LOCAL_CACHE, LOCAL_CACHE_SIZE) if LOCAL_CACHE else None
+    with S3Client(SERVER, SERVER_ACCESS_KEY, SERVER_SECRET_KEY, LAYOUT, PART_SIZE, PART_CONCURRENCY, max(WORKERS, MAX_WORKERS) * PART_CONCURRENCY, local_cache = local_cache) as s3:
         remote_prefix = s3.normalize_path(ID)
         if not remote_prefix.endswith("/"):
             remote_prefix += "/"
 
-        log("CACHE", f"Restore remote cache {SERVER_BUCKET}/{remote_prefix} to local directory {PATH}")
-        s3.download_directory(PATH, SERVER_BUCKET, remote_prefix, 8, lambda p: log("CACHE", f"Restoring from cache {p:.1f}%"))
+        # Falls back to the most recent cache matching the first possible restore key
+        matched_prefix = s3.find_cache(SERVER_BUCKET, remote_prefix, [s3.normalize_path(key) for key in RESTORE_KEYS])
+        set_output("cache-hit", "true" if matched_prefix == remote_prefix else "false")
+        set_output("matched-key", matched_prefix.removesuffix("/") if matched_prefix else "")
+        if matched_prefix is None:
+            log("CACHE", f"No cache found for {remote_prefix}{f' or restore keys {RESTORE_KEYS}' if RESTORE_KEYS else ''}")
+            matched_prefix = remote_prefix
+        elif matched_prefix != remote_prefix:
+            log("CACHE", f"No cache found for {remote_prefix}, using {matched_prefix}")
 
-if ACTION == "cache":
-    cache()
-elif ACTION == "restore":
-    restore()
-else:
-    log("CACHE", f"Unknown action: {ACTION}")
+        log("CACHE", f"Restore remote cache {SERVER_BUCKET}/{matched_prefix} to local directory {PATH}")
+        hash_index = HashIndex(HASH_INDEX).load() if INCREMENTAL else None
+        s3.download_directory(PATH, SERVER_BUCKET, matched_prefix, WORKERS, progress("Restoring from cache"), hash_index = hash_index, incremental = INCREMENTAL, prune = PRUNE, max_workers = MAX_WORKERS, adaptive = ADAPTIVE_CONCURRENCY)
+        report_metrics(s3.metrics, f"Restore {SERVER_BUCKET}/{matched_prefix}")
+
+# Compression worker processes import this module again
+if __name__ == "__main__":
+    if ACTION == "cache":
+        cache()
+    elif ACTION == "restore":
+        restore()
+    else:
+        log("CACHE", f"Unknown action: {ACTION}")
@@ -0,0 +1,28 @@
+import gzip
+import json
+
+CACHE_INDEX_NAME = ".cache-index.json.gz"
+CACHE_INDEX_VERSION = 1
+
+# Time of the last upload of every cache prefix in a bucket, restores look up fallback caches here instead of listing the bucket
+class CacheIndex:
+    def __init__(self, entries = None):
+        self.entries = entries if entries is not None else {}
+
+    def to_bytes(self):
+        data = {
+            "version": CACHE_INDEX_VERSION,
+            "entries": self.entries
+        }
+        return gzip.compress(json.dumps(data, separators = (",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def from_bytes(data):
+        data = json.loads(gzip.decompress(data).decode("utf-8"))
+        if data.get("version") != CACHE_INDEX_VERSION:
+            raise ValueError(f"Unsupported cache index version {data.get('version')}")
+        return CacheIndex(data["entries"])
+
+    def matches(self, key):
+        # Prefixes starting with key, most recently written first
+        return sorted((prefix for prefix in self.entries if prefix.startswith(key)), key = lambda prefix: self.entries[prefix], reverse = True)
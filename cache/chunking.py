@@ -0,0 +1,19 @@
+import hashlib
+from fastcdc import fastcdc
+
+CHUNKS_DIR = ".chunks/"
+
+# Files above the threshold are split into chunks of 256 KiB to 4 MiB, 1 MiB on average
+CHUNK_THRESHOLD = 64 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+def chunk_key(remote_prefix, hash):
+    return f"{remote_prefix}{CHUNKS_DIR}{hash[:2]}/{hash}"
+
+def chunk_file(file_path):
+    # Chunk boundaries depend on the content (FastCDC), so inserting or removing data only changes the chunks around it
+    # Yields (offset, length, sha256, data)
+    for chunk in fastcdc(file_path, MIN_CHUNK_SIZE, AVG_CHUNK_SIZE, MAX_CHUNK_SIZE, fat = True, hf = hashlib.sha256):
+        yield (chunk.offset, chunk.length, chunk.hash, chunk.data)
@@ -0,0 +1,63 @@
+import os
+import math
+import tempfile
+from collections import Counter
+import zstandard
+
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LEVEL = 3
+
+# Files below this size are stored raw, the request overhead dominates their transfer time
+MIN_COMPRESS_SIZE = 4 * 1024
+
+# Compressed objects have to save at least this fraction of the size, otherwise the raw file is stored
+MIN_SAVINGS = 0.05
+
+# Formats which are compressed already, compressing them again only costs time
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".lz4", ".br",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ktx", ".ktx2", ".astc", ".basis",
+    ".mp3", ".ogg", ".opus", ".aac", ".m4a", ".mp4", ".webm", ".mov", ".mkv", ".avi", ".bank",
+    ".unitypackage", ".bundle", ".apk", ".aab", ".ipa", ".jar", ".nupkg"
+}
+
+# Samples with more bits of entropy per byte than this are most likely compressed or encrypted data
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+MAX_ENTROPY = 7.5
+
+CHUNK_SIZE = 1024 * 1024
+
+def sample_entropy(file_path):
+    with open(file_path, "rb") as f:
+        sample = f.read(ENTROPY_SAMPLE_SIZE)
+    if not sample:
+        return 0.0
+    length = len(sample)
+    return -sum(count / length * math.log2(count / length) for count in Counter(sample).values())
+
+def is_compressible(file_path, size):
+    # Cheap check before handing the file to a worker process, the content is sampled by compress_file
+    return size >= MIN_COMPRESS_SIZE and os.path.splitext(file_path)[1].lower() not in INCOMPRESSIBLE_EXTENSIONS
+
+def compress_file(file_path, level = COMPRESSION_LEVEL):
+    # Runs in a worker process, returns the path of the compressed temporary file or None if compression doesn't pay off
+    if sample_entropy(file_path) > MAX_ENTROPY:
+        return None
+    size = os.path.getsize(file_path)
+    fd, tmp_path = tempfile.mkstemp(suffix = ".zst")
+    try:
+        compressor = zstandard.ZstdCompressor(level = level)
+        with os.fdopen(fd, "wb") as tmp, open(file_path, "rb") as f:
+            compressor.copy_stream(f, tmp, size = size, read_size = CHUNK_SIZE, write_size = CHUNK_SIZE)
+        if os.path.getsize(tmp_path) > size * (1.0 - MIN_SAVINGS):
+            os.remove(tmp_path)
+            return None
+        return tmp_path
+    except:
+        os.remove(tmp_path)
+        raise
+
+def decompress_stream(stream, file):
+    decompressor = zstandard.ZstdDecompressor()
+    with open(file, "wb") as f:
+        decompressor.copy_stream(stream, f, read_size = CHUNK_SIZE, write_size = CHUNK_SIZE)
@@ -0,0 +1,59 @@
+import threading
+import time
+from log import *
+
+ADJUST_INTERVAL = 2.0
+
+# Limits the number of concurrent transfers. In adaptive mode the limit is adjusted AIMD-style:
+# failures halve it, otherwise it grows by one as long as the throughput does not drop and shrinks by one when it does.
+class ConcurrencyLimiter:
+    def __init__(self, limit, maximum = None, adaptive = False, minimum = 1, interval = ADJUST_INTERVAL):
+        self.limit = limit
+        self.maximum = maximum or limit
+        self.minimum = minimum
+        self.adaptive = adaptive
+        self.interval = interval
+        self.active = 0
+        self.condition = threading.Condition()
+
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_failures = 0
+        self.last_throughput = None
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, transferred, failed):
+        with self.condition:
+            self.active -= 1
+            self.window_bytes += transferred
+            self.window_failures += failed
+            if self.adaptive:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+
+        throughput = self.window_bytes / elapsed
+        previous_limit = self.limit
+        if self.window_failures > 0:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.last_throughput is None or throughput >= self.last_throughput * 0.95:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(self.minimum, self.limit - 1)
+
+        if self.limit != previous_limit:
+            log("S3", f"Concurrency {previous_limit} -> {self.limit} ({throughput / 1024 / 1024:.1f} MiB/s, {self.window_failures} failures)")
+        self.last_throughput = throughput
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_failures = 0
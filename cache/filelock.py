@@ -0,0 +1,162 @@
+import os
+import time
+import atexit
+import signal
+import threading
+from log import *
+
+# Shared by the cache, the checkout and the bootstrapper, the cache and the checkout also run on windows runners
+if os.name == "nt":
+    import msvcrt
+
+    def lock_file(file):
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+
+    def unlock_file(file):
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    lock_file_blocking = None
+else:
+    import fcntl
+
+    def lock_file(file):
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def unlock_file(file):
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def lock_file_blocking(file):
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+# Polling interval of wait_interval None where the kernel can't wait for the lock,
+# or with a timeout outside the main thread, as the alarm which ends the wait can only be handled by the main thread
+BLOCKING_POLL_INTERVAL = 0.1
+
+# Locks held by this process, released together on exit or when the process is terminated
+HELD_LOCKS = set()
+handlers_installed = False
+
+def release_all():
+    for lock in list(HELD_LOCKS):
+        lock.release()
+
+def on_signal(signum, frame):
+    # Releases the locks, then terminates the process like the default handler would
+    release_all()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+def install_handlers():
+    global handlers_installed
+    # signal handlers can only be installed by the main thread
+    if handlers_installed or threading.current_thread() is not threading.main_thread():
+        return
+    atexit.register(release_all)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    handlers_installed = True
+
+class LockFile:
+    def __init__(self, path, timeout = None, wait_interval = 1):
+        self.path = path
+        self.timeout = timeout
+        self.wait_interval = wait_interval
+        self.file = None
+        # Waiting and releasing are only logged if the lock was contended
+        self.contended = False
+
+    def acquire(self):
+        if self.file:
+            raise RuntimeError(f"[LockFile] Lock already acquired on {self.path}")
+
+        self.contended = False
+        self.file = open(self.path, "a")
+        if self.wait_interval is None and lock_file_blocking and (not self.timeout or threading.current_thread() is threading.main_thread()):
+            self.lock_blocking()
+            self.register()
+            return
+        wait_interval = self.wait_interval or BLOCKING_POLL_INTERVAL
+        start_time = time.time()
+
+        while True:
+            try:
+                lock_file(self.file)
+                break
+            except OSError:
+                if self.timeout and (time.time() - start_time) >= self.timeout:
+                    self.file.close()
+                    self.file = None
+                    raise TimeoutError(f"[LockFile] Timeout while waiting to acquire lock on {self.path}")
+
+                log("LockFile", f"Waiting for lock: {self.path}")
+                self.contended = True
+                time.sleep(wait_interval)
+
+        self.register()
+
+    def lock_blocking(self):
+        # Waits in the kernel instead of polling (wait_interval None), an alarm interrupts the wait on timeout
+        try:
+            lock_file(self.file)
+            return
+        except OSError:
+            log("LockFile", f"Waiting for lock: {self.path}")
+            self.contended = True
+
+        if self.timeout:
+            def on_timeout(*_):
+                raise TimeoutError(f"[LockFile] Timeout while waiting to acquire lock on {self.path}")
+            previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            lock_file_blocking(self.file)
+        except:
+            self.file.close()
+            self.file = None
+            raise
+        finally:
+            if self.timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+
+    def try_acquire(self):
+        # Returns whether the lock was acquired, without waiting
+        if self.file:
+            raise RuntimeError(f"[LockFile] Lock already acquired on {self.path}")
+
+        self.contended = False
+        self.file = open(self.path, "a")
+        try:
+            lock_file(self.file)
+        except OSError:
+            self.file.close()
+            self.file = None
+            return False
+        self.register()
+        return True
+
+    def register(self):
+        HELD_LOCKS.add(self)
+        install_handlers()
+
+    def release(self):
+        try:
+            if self.file:
+                unlock_file(self.file)
+                self.file.close()
+                self.file = None
+                HELD_LOCKS.discard(self)
+                if self.contended:
+                    log("LockFile", f"Released lock: {self.path}")
+                    self.contended = False
+        except Exception as e:
+            log("LockFile", f"Error releasing lock: {e}")
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,159 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from log import *
+from filelock import LockFile
+
+LOCAL_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Trimming removes the least recently used objects until the cache is below this fraction of the size limit
+TRIM_TARGET = 0.9
+
+# Temporary files of interrupted writes are removed after this many seconds
+STALE_TEMP_AGE = 3600
+
+LOCK_NAME = ".lock"
+TEMP_SUFFIX = ".tmp"
+
+# Content addressed store on a local or shared disk in front of S3: sha256 -> file
+# Files are written to a temporary file and moved into place, so concurrent runners never see partial objects
+# The modification time of a file is its last use, trim removes the least recently used files above the size limit
+class LocalCache:
+    def __init__(self, path, max_size = LOCAL_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+
+    def object_path(self, hash):
+        return os.path.join(self.path, hash[:2], hash)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def open(self, hash):
+        # Returns an open file of the object or None, the object might be evicted by another runner at any time
+        path = self.object_path(hash)
+        try:
+            file = open(path, "rb")
+        except OSError:
+            self.count(False)
+            return None
+        self.touch(path)
+        self.count(True)
+        return file
+
+    def get(self, hash, file):
+        # Copies the object to file, returns whether it was found
+        source = self.open(hash)
+        if source is None:
+            return False
+        try:
+            os.makedirs(os.path.dirname(file) or ".", exist_ok = True)
+            tmp_path = f"{file}.part"
+            with source, open(tmp_path, "wb") as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.replace(tmp_path, file)
+            return True
+        except OSError as e:
+            log("LOCAL_CACHE", f"Failed to copy {hash} to {file}: {e}")
+            return False
+
+    def read(self, hash):
+        source = self.open(hash)
+        if source is None:
+            return None
+        with source:
+            return source.read()
+
+    def write(self, hash, write_function):
+        # Returns whether the object is stored
+        path = self.object_path(hash)
+        if self.touch(path):
+            return True
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            fd, tmp_path = tempfile.mkstemp(suffix = TEMP_SUFFIX, dir = os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write_function(f)
+                os.replace(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+            return True
+        except OSError as e:
+            log("LOCAL_CACHE", f"Failed to store {hash}: {e}")
+            return False
+
+    def put(self, hash, file):
+        def write_function(target):
+            with open(file, "rb") as source:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        return self.write(hash, write_function)
+
+    def put_bytes(self, hash, data):
+        return self.write(hash, lambda target: target.write(data))
+
+    def trim(self):
+        # Only one runner trims at a time, the others skip it
+        try:
+            with LockFile(os.path.join(self.path, LOCK_NAME), timeout = 0.1, wait_interval = 0.1):
+                self.trim_locked()
+        except TimeoutError:
+            log("LOCAL_CACHE", f"Local cache {self.path} is trimmed by another runner")
+
+    def trim_locked(self):
+        now = time.time()
+        files = []
+        total_size = 0
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(TEMP_SUFFIX):
+                    if now - stat.st_mtime > STALE_TEMP_AGE:
+                        self.remove(entry.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        removed = 0
+        target_size = self.max_size * TRIM_TARGET
+        for _, size, path in sorted(files):
+            if total_size <= target_size:
+                break
+            # files which are currently read by another runner can't be removed on windows
+            if self.remove(path):
+                total_size -= size
+                removed += 1
+        log("LOCAL_CACHE", f"Removed {removed} least recently used objects, {total_size / 1024 / 1024:.0f} MiB remaining")
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
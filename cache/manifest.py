@@ -0,0 +1,50 @@
+import gzip
+import json
+
+MANIFEST_NAME = ".cache-manifest.json.gz"
+MANIFEST_VERSION = 1
+
+# Mirrors the objects stored below a cache prefix: relative key -> [sha256, size] or [sha256, size, pack]
+# The hash is None for objects whose content is unknown (e.g. found by listing the prefix)
+# Packed files are not stored as separate objects but inside of the referenced pack (pack -> stored size)
+# Chunked files are stored as the chunks of their chunk list (sha256 -> [[chunk sha256, length]])
+class Manifest:
+    def __init__(self, files = None, packs = None, chunks = None):
+        self.files = files if files is not None else {}
+        self.packs = packs if packs is not None else {}
+        self.chunks = chunks if chunks is not None else {}
+
+    @staticmethod
+    def key(remote_prefix):
+        return f"{remote_prefix}{MANIFEST_NAME}"
+
+    def to_bytes(self):
+        data = {
+            "version": MANIFEST_VERSION,
+            "files": self.files,
+            "packs": self.packs,
+            "chunks": self.chunks
+        }
+        return gzip.compress(json.dumps(data, separators = (",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def from_bytes(data):
+        data = json.loads(gzip.decompress(data).decode("utf-8"))
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version {data.get('version')}")
+        return Manifest(data["files"], data.get("packs", {}), data.get("chunks", {}))
+
+    @staticmethod
+    def is_packed(entry):
+        return len(entry) > 2 and entry[2] is not None
+
+    def unreferenced_packs(self):
+        referenced = set(entry[2] for entry in self.files.values() if self.is_packed(entry))
+        return [name for name in self.packs if name not in referenced]
+
+    def unreferenced_chunk_lists(self):
+        referenced = set(entry[0] for entry in self.files.values() if not self.is_packed(entry))
+        return [hash for hash in self.chunks if hash not in referenced]
+
+    def referenced_chunks(self):
+        return set(chunk[0] for chunks in self.chunks.values() for chunk in chunks)
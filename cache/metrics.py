@@ -0,0 +1,184 @@
+import json
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in milliseconds, slower requests are counted in the last bucket
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+SLOWEST_FILES = 10
+
+# Requests of the Minio client that are timed, remove_objects is lazy and only sends its requests while iterating the result
+TIMED_REQUESTS = ["bucket_exists", "stat_object", "get_object", "put_object", "fput_object", "fget_object", "copy_object"]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # name -> [busy seconds, first start, last end, count], stages of a pipeline overlap so the wall time is the span
+        self.phases = {}
+        # name -> [count, total seconds, max seconds, histogram]
+        self.requests = {}
+        # name -> [objects, bytes]
+        self.transfers = {}
+        self.retries = 0
+        self.failures = 0
+        self.slowest = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start, time.time())
+
+    def add_phase(self, name, start, end):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, start, end, 0])
+            phase[0] += end - start
+            phase[1] = min(phase[1], start)
+            phase[2] = max(phase[2], end)
+            phase[3] += 1
+
+    def add_request(self, name, seconds):
+        milliseconds = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if milliseconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            request = self.requests.setdefault(name, [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)])
+            request[0] += 1
+            request[1] += seconds
+            request[2] = max(request[2], seconds)
+            request[3][bucket] += 1
+
+    def add_transfer(self, name, objects, size):
+        with self.lock:
+            transfer = self.transfers.setdefault(name, [0, 0])
+            transfer[0] += objects
+            transfer[1] += size
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def add_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def add_file(self, name, size, seconds):
+        with self.lock:
+            entry = (seconds, name, size)
+            if len(self.slowest) < SLOWEST_FILES:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    @staticmethod
+    def percentile(histogram, count, fraction):
+        # Upper bound of the bucket containing the percentile, None if it is in the overflow bucket
+        threshold = count * fraction
+        seen = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, histogram):
+            seen += bucket_count
+            if seen >= threshold:
+                return bound
+        return None
+
+    def to_dict(self):
+        with self.lock:
+            duration = time.time() - self.start
+            transfer_time = self.phases["transfer"][2] - self.phases["transfer"][1] if "transfer" in self.phases else duration
+            return {
+                "duration": duration,
+                "phases": {
+                    name: { "wall": end - start, "busy": busy, "count": count }
+                    for name, (busy, start, end, count) in self.phases.items()
+                },
+                "transfers": {
+                    name: {
+                        "objects": objects,
+                        "bytes": size,
+                        "objects_per_second": objects / transfer_time if transfer_time else 0.0,
+                        "bytes_per_second": size / transfer_time if transfer_time else 0.0
+                    }
+                    for name, (objects, size) in self.transfers.items()
+                },
+                "requests": {
+                    name: {
+                        "count": count,
+                        "mean_ms": total / count * 1000,
+                        "p50_ms": self.percentile(histogram, count, 0.5),
+                        "p95_ms": self.percentile(histogram, count, 0.95),
+                        "max_ms": longest * 1000,
+                        "histogram": { f"<={bound}ms": bucket_count for bound, bucket_count in zip(LATENCY_BUCKETS, histogram) } | { f">{LATENCY_BUCKETS[-1]}ms": histogram[-1] }
+                    }
+                    for name, (count, total, longest, histogram) in self.requests.items()
+                },
+                "retries": self.retries,
+                "failures": self.failures,
+                "slowest_files": [
+                    { "name": name, "bytes": size, "seconds": seconds }
+                    for seconds, name, size in sorted(self.slowest, reverse = True)
+                ]
+            }
+
+    def to_markdown(self, title):
+        data = self.to_dict()
+        format_ms = lambda bound: f">{LATENCY_BUCKETS[-1]}" if bound is None else f"<={bound}"
+        lines = [f"### {title}", "", f"Total {data['duration']:.1f}s, {data['retries']} retries, {data['failures']} failed operations", ""]
+
+        lines += ["| Phase | Wall time | Busy time | Count |", "| --- | ---: | ---: | ---: |"]
+        lines += [f"| {name} | {phase['wall']:.2f}s | {phase['busy']:.2f}s | {phase['count']} |" for name, phase in data["phases"].items()]
+
+        if data["transfers"]:
+            lines += ["", "| Transfer | Objects | MiB | Objects/s | MiB/s |", "| --- | ---: | ---: | ---: | ---: |"]
+            lines += [
+                f"| {name} | {transfer['objects']} | {transfer['bytes'] / 1024 / 1024:.1f} | {transfer['objects_per_second']:.1f} | {transfer['bytes_per_second'] / 1024 / 1024:.1f} |"
+                for name, transfer in data["transfers"].items()
+            ]
+
+        if data["requests"]:
+            lines += ["", "| Request | Count | Mean ms | p50 ms | p95 ms | Max ms |", "| --- | ---: | ---: | ---: | ---: | ---: |"]
+            lines += [
+                f"| {name} | {request['count']} | {request['mean_ms']:.0f} | {format_ms(request['p50_ms'])} | {format_ms(request['p95_ms'])} | {request['max_ms']:.0f} |"
+                for name, request in data["requests"].items()
+            ]
+
+        if data["slowest_files"]:
+            lines += ["", "| Slowest files | MiB | Seconds |", "| --- | ---: | ---: |"]
+            lines += [f"| {file['name']} | {file['bytes'] / 1024 / 1024:.1f} | {file['seconds']:.2f} |" for file in data["slowest_files"]]
+        return "\n".join(lines) + "\n\n"
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    def write_summary(self, path, title):
+        with open(path, "a", encoding = "utf-8") as f:
+            f.write(self.to_markdown(title))
+
+class TimedClient:
+    # Forwards all calls to the Minio client and records the latency of its requests
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in TIMED_REQUESTS:
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.metrics.add_request(name, time.time() - start)
+        return timed
+
+    def remove_objects(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return list(self.client.remove_objects(*args, **kwargs))
+        finally:
+            self.metrics.add_request("remove_objects", time.time() - start)
@@ -0,0 +1,84 @@
+import os
+import hashlib
+import tarfile
+import tempfile
+import zstandard
+
+PACKS_DIR = ".packs/"
+PACK_EXTENSION = ".tar.zst"
+PACK_COMPRESSION_LEVEL = 3
+
+# A pack ends at the first boundary file after reaching the target size, so inserting or removing
+# a file only changes the packs around it instead of shifting every following pack
+BOUNDARY_MODULUS = 64
+
+def pack_key(remote_prefix, name):
+    return f"{remote_prefix}{PACKS_DIR}{name}{PACK_EXTENSION}"
+
+def is_boundary(relative_path):
+    digest = hashlib.md5(relative_path.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little") % BOUNDARY_MODULUS == 0
+
+class PackGrouper:
+    # Groups files (full_path, relative_path, s3_key, size) in the order they are added
+    def __init__(self, pack_size):
+        self.pack_size = pack_size
+        self.current = []
+        self.current_size = 0
+
+    def add(self, file):
+        self.current.append(file)
+        self.current_size += file[3] + tarfile.BLOCKSIZE
+        if self.current_size >= self.pack_size * 2 or (self.current_size >= self.pack_size and is_boundary(file[1])):
+            return self.flush()
+        return None
+
+    def flush(self):
+        group = self.current
+        self.current = []
+        self.current_size = 0
+        return group or None
+
+def pack_name(members):
+    # members: [(relative_path, sha256, size)], the name identifies the exact pack content
+    sha = hashlib.sha256()
+    for relative_path, hash, size in members:
+        sha.update(f"{relative_path}\0{hash}\0{size}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+def build_pack(files):
+    # files: [(full_path, relative_path, size)], returns a temporary file positioned at the start and its length
+    tmp = tempfile.TemporaryFile()
+    try:
+        compressor = zstandard.ZstdCompressor(level = PACK_COMPRESSION_LEVEL)
+        with compressor.stream_writer(tmp, closefd = False) as writer:
+            with tarfile.open(fileobj = writer, mode = "w|") as tar:
+                for full_path, relative_path, size in files:
+                    info = tarfile.TarInfo(relative_path)
+                    info.size = size
+                    with open(full_path, "rb") as f:
+                        tar.addfile(info, f)
+        length = tmp.tell()
+        tmp.seek(0)
+        return (tmp, length)
+    except:
+        tmp.close()
+        raise
+
+def extract_pack(stream, targets):
+    # targets: relative_path -> local path, members not in targets are skipped
+    extracted = []
+    decompressor = zstandard.ZstdDecompressor()
+    with decompressor.stream_reader(stream, closefd = False) as reader:
+        with tarfile.open(fileobj = reader, mode = "r|") as tar:
+            for member in tar:
+                local_path = targets.get(member.name)
+                if local_path is None or not member.isfile():
+                    continue
+                os.makedirs(os.path.dirname(local_path), exist_ok = True)
+                source = tar.extractfile(member)
+                with open(local_path, "wb") as f:
+                    while chunk := source.read(1024 * 1024):
+                        f.write(chunk)
+                extracted.append(member.name)
+    return extracted
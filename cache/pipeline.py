@@ -0,0 +1,81 @@
+import queue
+import threading
+
+QUEUE_SIZE = 256
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+# Runs the items of source through stages of worker threads, stages are (function, workers) tuples.
+# Stages are connected by bounded queues, so every stage starts as soon as the first item arrives
+# and a stage blocks when the next one can't keep up. Yields the results of the last stage as they complete.
+def run_pipeline(source, stages, queue_size = QUEUE_SIZE):
+    queues = [queue.Queue(queue_size) for _ in range(len(stages))]
+    results = queue.Queue(queue_size)
+    stop = threading.Event()
+    threads = []
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source_queue):
+        while not stop.is_set():
+            try:
+                return source_queue.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except Exception as e:
+            put(results, _Failure(e))
+        finally:
+            for _ in range(stages[0][1]):
+                put(queues[0], _DONE)
+
+    def work(index, function, remaining):
+        output = queues[index + 1] if index + 1 < len(stages) else results
+        try:
+            while (item := get(queues[index])) is not _DONE:
+                if not put(output, function(item)):
+                    return
+        except Exception as e:
+            put(results, _Failure(e))
+        finally:
+            with remaining[1]:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                for _ in range(stages[index + 1][1] if index + 1 < len(stages) else 1):
+                    put(output, _DONE)
+
+    threads.append(threading.Thread(target = produce, daemon = True))
+    for index, (function, workers) in enumerate(stages):
+        remaining = [workers, threading.Lock()]
+        for _ in range(workers):
+            threads.append(threading.Thread(target = work, args = (index, function, remaining), daemon = True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while (item := get(results)) is not _DONE:
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -1,30 +1,165 @@
 import os
+import io
+import shutil
+import json
 import hashlib
+import threading
 import time
+import random
+import certifi
+import urllib3
 from log import *
+from manifest import Manifest, MANIFEST_NAME
+from cache_index import CacheIndex, CACHE_INDEX_NAME
+from packs import PACKS_DIR, PACK_EXTENSION, PackGrouper, pack_key, pack_name, build_pack, extract_pack
+from pipeline import run_pipeline
+from concurrency import ConcurrencyLimiter
+from metrics import Metrics, TimedClient
+from chunking import CHUNKS_DIR, chunk_key, chunk_file
+from compression import COMPRESSION_ZSTD, is_compressible, compress_file, decompress_stream
 
 from minio import Minio
 from minio.error import S3Error
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from minio.deleteobjects import DeleteObject
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+LAYOUT_PREFIX = "prefix"
+LAYOUT_CAS = "cas"
+
+# Content addressed layout: blobs are shared by all cache ids, each id only stores a manifest in refs/
+CAS_PREFIX = ".cas/"
+CAS_REFS = f"{CAS_PREFIX}refs/"
+CAS_BLOBS = f"{CAS_PREFIX}blobs/"
+GC_GRACE_PERIOD = 3600
+GC_CANDIDATES = f"{CAS_PREFIX}gc-candidates.json"
+
+# Attempts to add a cache prefix to the cache index while other runners update it as well
+INDEX_UPDATE_ATTEMPTS = 5
+
+# Maximum number of keys of a single multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
+# Objects larger than the part size are transferred in parts by multiple threads
+PART_SIZE = 64 * 1024 * 1024
+PART_WORKERS = 4
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+HASH_WORKERS = 4
+
+# Upper bound of transfer threads when the concurrency is adjusted automatically
+MAX_WORKERS = 32
+
+class HashIndex:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Starts a new run, the entries seen and the counts of the previous run are dropped
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            log("S3", f"Could not read hash index {self.path}, rebuilding it ({e})")
+            self.entries = {}
+        return self
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.seen, f, separators = (",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def get_hash(self, relative_path, file_path):
+        stat = os.stat(file_path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+        entry = self.entries.get(relative_path)
+        if entry and entry[:3] == key:
+            with self.lock:
+                self.hits += 1
+                self.seen[relative_path] = entry
+            return (entry[3], stat.st_size)
+
+        hash, size = S3Client.compute_file_hash(file_path)
+        with self.lock:
+            self.misses += 1
+            self.seen[relative_path] = key + [hash]
+        return (hash, size)
+
+    def set_hash(self, relative_path, file_path, hash):
+        stat = os.stat(file_path)
+        with self.lock:
+            self.seen[relative_path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, hash]
 
 class S3Client:
-    def __init__(self, server, access_key, secret_key):
+    def __init__(self, server, access_key, secret_key, layout = LAYOUT_PREFIX, part_size = PART_SIZE, part_workers = PART_WORKERS, pool_size = None, compression_level = None, compression_workers = None, local_cache = None, metrics = None, secure = True):
         self.server = server
+        self.secure = secure
         self.access_key = access_key
         self.secret_key = secret_key
+        self.layout = layout
+        self.part_size = part_size
+        self.part_workers = part_workers
+        # every transfer thread can use one connection per part
+        self.pool_size = pool_size or MAX_WORKERS * part_workers
+        self.known_blobs = set()
+        self.known_chunks = set()
+        # Objects are only compressed if a level is set, compression runs in worker processes to not serialize on the GIL
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers or os.cpu_count()
+        self.compression_pool = None
+        # Optional LocalCache which serves downloads before asking the server
+        self.local_cache = local_cache
+        self.metrics = metrics or Metrics()
+        self.http = None
         self.s3 = None
 
+        if layout not in [LAYOUT_PREFIX, LAYOUT_CAS]:
+            raise ValueError(f"Unknown cache layout: {layout}")
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"Part size must be at least {MIN_PART_SIZE} bytes")
+
     def __enter__(self):
-        self.s3 = Minio(
+        # Same settings as the default client of Minio, which only keeps 10 connections per host
+        timeout = 300
+        self.http = urllib3.PoolManager(
+            timeout = urllib3.Timeout(connect = timeout, read = timeout),
+            maxsize = self.pool_size,
+            cert_reqs = "CERT_REQUIRED",
+            ca_certs = os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries = urllib3.Retry(
+                total = 5,
+                backoff_factor = 0.2,
+                status_forcelist = [500, 502, 503, 504]
+            )
+        )
+        self.s3 = TimedClient(Minio(
             self.server,
             access_key = self.access_key,
             secret_key = self.secret_key,
-            secure = True
-        )
+            secure = self.secure,
+            http_client = self.http
+        ), self.metrics)
+        if self.compression_level is not None:
+            self.compression_pool = ProcessPoolExecutor(self.compression_workers)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass # Minio closes connections automatically
+        if self.compression_pool:
+            self.compression_pool.shutdown()
+        self.http.clear()
 
     @staticmethod
     def normalize_path(*parts):
@@ -32,158 +167,1008 @@ class S3Client:
     
     @staticmethod
     def compute_file_hash(file_path):
+        sha = hashlib.sha256()
+        size = 0
         with open(file_path, "rb") as f:
-            data = f.read()
-        return (hashlib.sha256(data).hexdigest(), len(data))
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                sha.update(chunk)
+                size += len(chunk)
+        return (sha.hexdigest(), size)
 
-    @staticmethod
-    def retry(operation, retries = 3, delay = 0.1):
+    def hash_file(self, full_path, relative_path, hash_index):
+        if hash_index:
+            return hash_index.get_hash(relative_path, full_path)
+        return self.compute_file_hash(full_path)
+
+    def walk_files(self, local_dir):
+        # Depth first in name order, so files are enumerated in the same order on every run
+        directories = [local_dir]
+        while directories:
+            directory = directories.pop()
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key = lambda n: n.name)
+
+            subdirectories = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirectories.append(entry.path)
+                elif entry.is_file():
+                    full_path = self.normalize_path(directory, entry.name)
+                    yield (full_path, os.path.relpath(full_path, local_dir), entry.stat().st_size)
+            directories.extend(reversed(subdirectories))
+
+    def manifest_key(self, remote_prefix):
+        if self.layout == LAYOUT_CAS:
+            return f"{CAS_REFS}{remote_prefix}{MANIFEST_NAME}"
+        return Manifest.key(remote_prefix)
+
+    def object_key(self, remote_prefix, relative_path, hash):
+        if self.layout == LAYOUT_CAS:
+            return f"{CAS_BLOBS}{hash[:2]}/{hash}"
+        return f"{remote_prefix}{relative_path}"
+
+    def pack_object_key(self, remote_prefix, name):
+        return pack_key(CAS_PREFIX if self.layout == LAYOUT_CAS else remote_prefix, name)
+
+    def chunk_object_key(self, remote_prefix, hash):
+        # Chunks are content addressed in both layouts, the cas layout shares them with the blobs
+        if self.layout == LAYOUT_CAS:
+            return self.object_key(None, None, hash)
+        return chunk_key(remote_prefix, hash)
+
+    def retry(self, operation, retries = 3, delay = 0.1):
         for i in range(retries):
             try:
                 return operation()
             except Exception as e:
                 if i == retries - 1:
                     log("S3", f"Operation failed after {retries} retries: {e}")
-                    return False
+                    self.metrics.add_failure()
+                    return None
+                self.metrics.add_retry()
                 time.sleep(delay * (i + 1))
     
     def can_skip_file(self, bucket, object_name, local_path, hash, size):
         try:
             stat = self.s3.stat_object(bucket, object_name)
-            return stat.size == size and stat.metadata and stat.metadata.get("x-amz-meta-sha256") == hash
+            if not stat.metadata or stat.metadata.get("x-amz-meta-sha256") != hash:
+                return False
+            return stat.size == size or stat.metadata.get("x-amz-meta-compression") == COMPRESSION_ZSTD
         except:
             return False
         
-    def upload_file(self, bucket, object_name, file):
-        hash, size = self.compute_file_hash(file)
+    def upload_file(self, bucket, object_name, file, hash = None, size = None, check_remote = True):
+        if hash is None:
+            hash, size = self.compute_file_hash(file)
 
-        if self.can_skip_file(bucket, object_name, file, hash, size):
+        if check_remote and self.can_skip_file(bucket, object_name, file, hash, size):
             return False
         
+        metadata = { "sha256": hash }
+        compressed = self.compress_file(file, size)
+        if compressed:
+            metadata["compression"] = COMPRESSION_ZSTD
+
+        # Minio uploads the parts of large files in parallel and only buffers as many parts as there are threads
         def operation():
-            self.s3.fput_object(bucket, object_name, file, metadata = { "sha256": hash })
+            self.s3.fput_object(bucket, object_name, compressed or file, metadata = metadata, part_size = self.part_size, num_parallel_uploads = self.part_workers)
+            return True
+        try:
+            return self.retry(operation)
+        finally:
+            if compressed:
+                os.remove(compressed)
+
+    def compress_file(self, file, size):
+        # Returns the path of a temporary compressed copy or None if the file is stored raw
+        if not self.compression_pool or not is_compressible(file, size):
+            return None
+        try:
+            return self.compression_pool.submit(compress_file, file, self.compression_level).result()
+        except Exception as e:
+            log("S3", f"Failed to compress {file}, uploading it uncompressed ({e})")
+            return None
+
+    def is_compressed(self, bucket, object_name):
+        try:
+            stat = self.s3.stat_object(bucket, object_name)
+            return bool(stat.metadata) and stat.metadata.get("x-amz-meta-compression") == COMPRESSION_ZSTD
+        except:
+            return False
+
+    def download_file(self, bucket, object_name, file, size = None):
+        # Compressed objects can't be split into ranges of the original file, they are decompressed while streaming
+        if size is not None and size > self.part_size and self.part_workers > 1 and not self.is_compressed(bucket, object_name):
+            return self.download_ranged(bucket, object_name, file, size)
+
+        def operation():
+            os.makedirs(os.path.dirname(file) or ".", exist_ok = True)
+            tmp_path = f"{file}.part"
+            response = self.s3.get_object(bucket, object_name)
+            try:
+                if response.headers.get("x-amz-meta-compression") == COMPRESSION_ZSTD:
+                    decompress_stream(response, tmp_path)
+                else:
+                    with open(tmp_path, "wb") as f:
+                        while chunk := response.read(HASH_CHUNK_SIZE):
+                            f.write(chunk)
+            finally:
+                response.close()
+                response.release_conn()
+            os.replace(tmp_path, file)
             return True
         return self.retry(operation)
-    
-    def download_file(self, bucket, object_name, file):        
+
+    def download_range(self, bucket, object_name, file, offset, length, object_offset = None):
+        # Writes length bytes of the object to offset of the file, they are read from the same offset of the object by default
         def operation():
-            self.s3.fget_object(bucket, object_name, file)
+            response = self.s3.get_object(bucket, object_name, offset if object_offset is None else object_offset, length)
+            try:
+                with open(file, "r+b") as f:
+                    f.seek(offset)
+                    while chunk := response.read(HASH_CHUNK_SIZE):
+                        f.write(chunk)
+            finally:
+                response.close()
+                response.release_conn()
             return True
         return self.retry(operation)
-    
-    def upload_directory(self, local_dir, bucket, remote_prefix, workers = 8, progress_callback = None, callback_interval = 1.0):
-        if not self.s3.bucket_exists(bucket):
-            log("S3", f"Bucket {bucket} does not exist. Skipping upload")
-            return
 
-        all_files = []
+    def download_ranged(self, bucket, object_name, file, size):
+        # Parts are streamed into their position of a preallocated file, so memory usage does not depend on the file size
+        os.makedirs(os.path.dirname(file) or ".", exist_ok = True)
+        tmp_path = f"{file}.part"
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+
+        with ThreadPoolExecutor(self.part_workers) as executor:
+            futures = [
+                executor.submit(self.download_range, bucket, object_name, tmp_path, offset, min(self.part_size, size - offset))
+                for offset in range(0, size, self.part_size)
+            ]
+            results = [future.result() for future in futures]
+
+        if not all(results):
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, file)
+        return True
+
+    def remote_hash(self, bucket, object_name):
+        try:
+            stat = self.s3.stat_object(bucket, object_name)
+            return stat.metadata.get("x-amz-meta-sha256") if stat.metadata else None
+        except:
+            return None
+
+    def is_local_match(self, local_path, relative_path, hash, size, hash_index):
+        # A local file which is locked or vanished while it is checked is downloaded again
+        try:
+            if hash is None or not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+                return False
+            local_hash, _ = self.hash_file(local_path, relative_path, hash_index)
+        except OSError as e:
+            log("S3", f"Failed to check {relative_path}, downloading it: {e}")
+            return False
+        return local_hash == hash
+
+    def check_entry(self, bucket, object_name, local_path, relative_path, remote, hash_index):
+        # Returns whether the file has to be downloaded and the remote hash if known
+        hash, size = remote[:2]
+        try:
+            matches_size = os.path.isfile(local_path) and os.path.getsize(local_path) == size
+        except OSError:
+            matches_size = False
+        if matches_size:
+            if hash is None:
+                hash = self.remote_hash(bucket, object_name)
+            if self.is_local_match(local_path, relative_path, hash, size, hash_index):
+                return (False, hash)
+        return (True, hash)
+
+    def download_entry(self, bucket, object_name, local_path, relative_path, hash, size, hash_index):
+        if self.local_cache and hash is not None and self.local_cache.get(hash, local_path):
+            result = True
+        else:
+            result = self.download_file(bucket, object_name, local_path, size)
+            if result and self.local_cache and hash is not None:
+                self.local_cache.put(hash, local_path)
+        if result and hash_index and hash is not None:
+            hash_index.set_hash(relative_path, local_path, hash)
+        return result
+
+    def download_chunked_entry(self, bucket, remote_prefix, local_path, relative_path, hash, size, chunks, hash_index):
+        result = self.download_chunks(bucket, remote_prefix, local_path, size, chunks)
+        if result and hash_index:
+            hash_index.set_hash(relative_path, local_path, hash)
+        return result
+
+    def download_chunks(self, bucket, remote_prefix, file, size, chunks):
+        # Chunks that are part of the existing local file are copied from it, only the others are downloaded
+        # Every chunk is written to its offset in a preallocated file, which replaces the local file when complete
+        local_chunks = {}
+        if os.path.isfile(file):
+            try:
+                for offset, length, chunk_hash, _ in chunk_file(file):
+                    local_chunks.setdefault(chunk_hash, offset)
+            except Exception as e:
+                log("S3", f"Failed to chunk local file {file}, downloading all chunks ({e})")
+                local_chunks = {}
+
+        os.makedirs(os.path.dirname(file) or ".", exist_ok = True)
+        tmp_path = f"{file}.part"
+        missing = []
+        with open(tmp_path, "wb") as target:
+            target.truncate(size)
+            source = open(file, "rb") if local_chunks else None
+            try:
+                offset = 0
+                for chunk_hash, length in chunks:
+                    if chunk_hash in local_chunks:
+                        source.seek(local_chunks[chunk_hash])
+                        target.seek(offset)
+                        target.write(source.read(length))
+                    elif (data := self.local_cache.read(chunk_hash) if self.local_cache else None) is not None:
+                        target.seek(offset)
+                        target.write(data)
+                    else:
+                        missing.append((offset, chunk_hash, length))
+                    offset += length
+            finally:
+                if source:
+                    source.close()
+
+        with ThreadPoolExecutor(self.part_workers) as executor:
+            futures = [
+                executor.submit(self.download_range, bucket, self.chunk_object_key(remote_prefix, chunk_hash), tmp_path, offset, length, 0)
+                for offset, chunk_hash, length in missing
+            ]
+            results = [future.result() for future in futures]
+
+        if not all(results):
+            os.remove(tmp_path)
+            return None
+        if self.local_cache:
+            with open(tmp_path, "rb") as f:
+                for offset, chunk_hash, length in missing:
+                    f.seek(offset)
+                    self.local_cache.put_bytes(chunk_hash, f.read(length))
+        os.replace(tmp_path, file)
+        return True
+
+    def check_pack(self, members, hash_index):
+        # Returns the members that have to be extracted, relative path -> local path
+        targets = {}
+        for local_path, relative_path, remote in members:
+            if not self.is_local_match(local_path, relative_path, remote[0], remote[1], hash_index):
+                targets[relative_path] = local_path
+        return targets
+
+    def download_pack(self, bucket, remote_prefix, name, members, targets, hash_index):
+        if not targets:
+            return 0
+
+        extracted = self.extract_cached_pack(bucket, remote_prefix, name, targets) if self.local_cache else None
+        if extracted is None:
+            def operation():
+                response = self.s3.get_object(bucket, self.pack_object_key(remote_prefix, name))
+                try:
+                    return extract_pack(response, targets)
+                finally:
+                    response.close()
+                    response.release_conn()
+            extracted = self.retry(operation)
+        if extracted is None:
+            return None
+
+        if hash_index:
+            hashes = { relative_path: remote[0] for _, relative_path, remote in members }
+            for relative_path in extracted:
+                hash_index.set_hash(relative_path, targets[relative_path], hashes[relative_path])
+        return len(extracted)
+
+    def extract_cached_pack(self, bucket, remote_prefix, name, targets):
+        # Packs are downloaded to the local cache and extracted from there, the name identifies the pack content
+        cached = self.local_cache.open(name)
+        if cached is None:
+            def operation():
+                response = self.s3.get_object(bucket, self.pack_object_key(remote_prefix, name))
+                try:
+                    return self.local_cache.write(name, lambda f: shutil.copyfileobj(response, f, HASH_CHUNK_SIZE))
+                finally:
+                    response.close()
+                    response.release_conn()
+            if not self.retry(operation):
+                return None
+            try:
+                cached = open(self.local_cache.object_path(name), "rb")
+            except OSError:
+                return None
+
+        try:
+            with cached:
+                return extract_pack(cached, targets)
+        except Exception as e:
+            log("S3", f"Failed to extract pack {name} from the local cache: {e}")
+            return None
+
+    def prune_directory(self, local_dir, manifest):
+        pruned = 0
         for root, _, files in os.walk(local_dir):
             for file in files:
                 full_path = self.normalize_path(root, file)
                 relative_path = os.path.relpath(full_path, local_dir)
+                if relative_path.endswith("-lock") or relative_path in manifest.files:
+                    continue
+                try:
+                    os.remove(full_path)
+                    pruned += 1
+                except OSError as e:
+                    log("S3", f"Failed to remove {full_path}: {e}")
+        return pruned
+
+    def load_manifest(self, bucket, remote_prefix):
+        response = None
+        try:
+            response = self.s3.get_object(bucket, self.manifest_key(remote_prefix))
+            return Manifest.from_bytes(response.read())
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                log("S3", f"Failed to load manifest of {bucket}/{remote_prefix}: {e}")
+            return None
+        except Exception as e:
+            log("S3", f"Failed to load manifest of {bucket}/{remote_prefix}: {e}")
+            return None
+        finally:
+            if response:
+                response.close()
+                response.release_conn()
+
+    def save_manifest(self, bucket, remote_prefix, manifest):
+        data = manifest.to_bytes()
+        def operation():
+            self.s3.put_object(bucket, self.manifest_key(remote_prefix), io.BytesIO(data), len(data), content_type = "application/gzip")
+            return True
+        if self.retry(operation) is None:
+            log("S3", f"Failed to save manifest of {bucket}/{remote_prefix}")
+
+    def list_manifest(self, bucket, remote_prefix):
+        # Fallback for prefixes without a manifest, content hashes are unknown until the next upload
+        manifest_key = self.manifest_key(remote_prefix)
+        manifest = Manifest()
+        if self.layout == LAYOUT_CAS:
+            return manifest
+
+        log("S3", f"No manifest found in {bucket}/{remote_prefix}, listing existing files...")
+        for obj in self.s3.list_objects(bucket, remote_prefix, True):
+            if obj.object_name != manifest_key and not obj.object_name.startswith((f"{remote_prefix}{PACKS_DIR}", f"{remote_prefix}{CHUNKS_DIR}")):
+                manifest.files[obj.object_name[len(remote_prefix):]] = [None, obj.size]
+        return manifest
+
+    def index_key(self):
+        return f"{CAS_PREFIX}{CACHE_INDEX_NAME}" if self.layout == LAYOUT_CAS else CACHE_INDEX_NAME
 
+    def load_index(self, bucket):
+        # Returns an empty index if it doesn't exist yet, raises on other errors so an update doesn't replace it
+        response = None
+        try:
+            response = self.s3.get_object(bucket, self.index_key())
+            return CacheIndex.from_bytes(response.read())
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return CacheIndex()
+            raise
+        finally:
+            if response:
+                response.close()
+                response.release_conn()
+
+    def update_index(self, bucket, remote_prefix):
+        # Not every server supports conditional writes, so the index is read back to detect concurrent updates that replaced the entry
+        timestamp = time.time()
+        for attempt in range(INDEX_UPDATE_ATTEMPTS):
+            try:
+                index = self.load_index(bucket)
+                if index.entries.get(remote_prefix, 0) >= timestamp:
+                    return True
+                index.entries[remote_prefix] = timestamp
+                data = index.to_bytes()
+                self.s3.put_object(bucket, self.index_key(), io.BytesIO(data), len(data), content_type = "application/gzip")
+                time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+                if self.load_index(bucket).entries.get(remote_prefix, 0) >= timestamp:
+                    return True
+            except Exception as e:
+                log("S3", f"Failed to update cache index of {bucket}: {e}")
+                return False
+        log("S3", f"Failed to update cache index of {bucket}, it was replaced by concurrent updates")
+        return False
+
+    def cache_exists(self, bucket, remote_prefix):
+        try:
+            self.s3.stat_object(bucket, self.manifest_key(remote_prefix))
+            return True
+        except:
+            return False
+
+    def find_cache(self, bucket, remote_prefix, restore_keys):
+        # Returns remote_prefix if it exists, otherwise the most recently written cache that starts with the first matching restore key
+        if self.cache_exists(bucket, remote_prefix):
+            return remote_prefix
+        if not restore_keys:
+            return None
+
+        try:
+            index = self.load_index(bucket)
+        except Exception as e:
+            log("S3", f"Failed to load cache index of {bucket}: {e}")
+            return None
+        for key in restore_keys:
+            for prefix in index.matches(key):
+                # the index is not updated when caches are removed
+                if prefix != remote_prefix and self.cache_exists(bucket, prefix):
+                    return prefix
+        return None
+
+    def upload_entry(self, bucket, remote_prefix, s3_key, full_path, relative_path, manifest, hash, size, chunked = False):
+        # Returns the upload result, hash, size, the chunk list if the file was chunked and the number of bytes sent
+        remote = manifest.files.get(relative_path)
+        if remote and remote[0] is not None:
+            if remote == [hash, size]:
+                return (False, hash, size, None, 0)
+            check_remote = False
+        else:
+            # unknown remote content, only ask the server if the sizes match
+            check_remote = remote is not None and remote[1] == size
+
+        if chunked:
+            if hash in manifest.chunks:
+                return (False, hash, size, manifest.chunks[hash], 0)
+            result, chunks, sent = self.upload_chunks(bucket, remote_prefix, full_path)
+            return (result, hash, size, chunks, sent)
+
+        if self.layout == LAYOUT_CAS:
+            if self.blob_exists(bucket, hash):
+                return (False, hash, size, None, 0)
+            s3_key = self.object_key(None, relative_path, hash)
+            result = self.upload_file(bucket, s3_key, full_path, hash, size, False)
+            if result:
+                self.known_blobs.add(hash)
+            return (result, hash, size, None, size if result else 0)
+
+        result = self.upload_file(bucket, s3_key, full_path, hash, size, check_remote)
+        return (result, hash, size, None, size if result else 0)
+
+    def upload_chunks(self, bucket, remote_prefix, file):
+        # Returns whether any chunk was uploaded (None if one failed), the chunk list of the file and the number of bytes sent
+        # Only a few chunks per thread are held in memory, the file is read while the previous chunks are uploaded
+        chunks = []
+        queued = set()
+        futures = set()
+        results = []
+        with ThreadPoolExecutor(self.part_workers) as executor:
+            try:
+                for _, length, chunk_hash, data in chunk_file(file):
+                    chunks.append([chunk_hash, length])
+                    if chunk_hash in queued:
+                        continue
+                    if len(futures) >= self.part_workers * 2:
+                        done, futures = wait(futures, return_when = FIRST_COMPLETED)
+                        results.extend(future.result() for future in done)
+                    futures.add(executor.submit(self.upload_chunk, bucket, remote_prefix, chunk_hash, data))
+                    queued.add(chunk_hash)
+            except Exception as e:
+                log("S3", f"Failed to chunk {file}: {e}")
+                results.append(None)
+            results.extend(future.result() for future in futures)
+
+        sent = sum(result for result in results if result)
+        if not all(result is not None for result in results):
+            return (None, chunks, sent)
+        return (sent > 0, chunks, sent)
+
+    def upload_chunk(self, bucket, remote_prefix, hash, data):
+        # Returns the number of bytes sent, 0 if the chunk exists already or None if it failed
+        if self.chunk_exists(bucket, hash):
+            return 0
+        def operation():
+            self.s3.put_object(bucket, self.chunk_object_key(remote_prefix, hash), io.BytesIO(data), len(data))
+            return True
+        if not self.retry(operation):
+            return None
+        (self.known_blobs if self.layout == LAYOUT_CAS else self.known_chunks).add(hash)
+        return len(data)
+
+    def chunk_exists(self, bucket, hash):
+        if self.layout == LAYOUT_CAS:
+            return self.blob_exists(bucket, hash)
+        # chunks of the prefix layout are only known from the manifest
+        return hash in self.known_chunks
+
+    def blob_exists(self, bucket, hash):
+        if hash in self.known_blobs:
+            return True
+        try:
+            self.s3.stat_object(bucket, self.object_key(None, None, hash))
+        except:
+            return False
+        self.known_blobs.add(hash)
+        return True
+
+    def load_known_blobs(self, bucket):
+        for obj in self.s3.list_objects(bucket, CAS_BLOBS, True):
+            self.known_blobs.add(obj.object_name.rsplit("/", 1)[-1])
+
+    def upload_pack(self, bucket, remote_prefix, group, manifest, hashes):
+        members = [(file[1], hash, size) for file, (hash, size) in zip(group, hashes)]
+        name = pack_name(members)
+        if name in manifest.packs:
+            return (False, name, members, manifest.packs[name])
+        if self.layout == LAYOUT_CAS:
+            try:
+                stat = self.s3.stat_object(bucket, self.pack_object_key(remote_prefix, name))
+                return (False, name, members, stat.size)
+            except:
+                pass
+
+        def operation():
+            data, length = build_pack([(file[0], relative_path, size) for file, (relative_path, _, size) in zip(group, members)])
+            with data:
+                self.s3.put_object(bucket, self.pack_object_key(remote_prefix, name), data, length, content_type = "application/zstd")
+            return length
+        stored_size = self.retry(operation)
+        return (None if stored_size is None else True, name, members, stored_size)
+
+    def remove_batch(self, bucket, object_names):
+        def operation():
+            errors = self.s3.remove_objects(bucket, [DeleteObject(object_name) for object_name in object_names])
+            return [(error.name, f"{error.code}: {error.message}") for error in errors]
+        errors = self.retry(operation)
+        if errors is None:
+            return [(object_name, "Request failed") for object_name in object_names]
+        return errors
+
+    def remove_objects(self, bucket, object_names, workers = 8, progress_callback = None, callback_interval = 1.0):
+        # Returns the names of the objects that could not be deleted
+        batches = [object_names[i:i + DELETE_BATCH_SIZE] for i in range(0, len(object_names), DELETE_BATCH_SIZE)]
+        failed = set()
+        processed = 0
+        total_objects = len(object_names)
+        last_callback_time = time.time()
+
+        start = time.time()
+        with ThreadPoolExecutor(workers) as executor:
+            futures = { executor.submit(self.remove_batch, bucket, batch): len(batch) for batch in batches }
+
+            for future in as_completed(futures):
+                for object_name, error in future.result():
+                    log("S3", f"Failed to delete {object_name} ({error})")
+                    failed.add(object_name)
+                processed += futures[future]
+
+                now = time.time()
+                if progress_callback and (now - last_callback_time) >= callback_interval:
+                    progress_callback(processed, total_objects)
+                    last_callback_time = now
+
+        if object_names:
+            self.metrics.add_phase("delete", start, time.time())
+            self.metrics.add_transfer("deleted", total_objects - len(failed), 0)
+        return failed
+
+    def list_manifests(self, bucket):
+        manifests = {}
+        for obj in self.s3.list_objects(bucket, CAS_REFS, True):
+            if not obj.object_name.endswith(MANIFEST_NAME):
+                continue
+            remote_prefix = obj.object_name[len(CAS_REFS):-len(MANIFEST_NAME)]
+            manifests[remote_prefix] = obj
+        return manifests
+
+    def mark_manifests(self, bucket, manifests, referenced):
+        # Adds the names of all blobs, chunks and packs referenced by the manifests, returns False if one can't be loaded
+        for remote_prefix in manifests:
+            manifest = self.load_manifest(bucket, remote_prefix)
+            if manifest is None:
+                log("S3", f"Could not load manifest of {remote_prefix}, skipping garbage collection")
+                return False
+            for entry in manifest.files.values():
+                referenced.add(entry[2] if Manifest.is_packed(entry) else entry[0])
+            referenced.update(manifest.referenced_chunks())
+        return True
+
+    def load_gc_candidates(self, bucket):
+        # Unreferenced objects of previous collections, object name -> time it was first seen unreferenced
+        response = None
+        try:
+            response = self.s3.get_object(bucket, GC_CANDIDATES)
+            return json.loads(response.read())
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                log("S3", f"Failed to load {GC_CANDIDATES}: {e}")
+            return {}
+        except ValueError as e:
+            log("S3", f"Failed to load {GC_CANDIDATES}: {e}")
+            return {}
+        finally:
+            if response:
+                response.close()
+                response.release_conn()
+
+    def save_gc_candidates(self, bucket, candidates):
+        data = json.dumps(candidates, separators = (",", ":")).encode("utf-8")
+        def operation():
+            self.s3.put_object(bucket, GC_CANDIDATES, io.BytesIO(data), len(data), content_type = "application/json")
+            return True
+        if self.retry(operation) is None:
+            log("S3", f"Failed to save {GC_CANDIDATES}")
+
+    def collect_garbage(self, bucket, grace_period = GC_GRACE_PERIOD):
+        # Mark: everything referenced by any cache id, sweep: unreferenced blobs, chunks and packs
+        # An upload can reuse an existing object long before it saves the manifest referencing it, so an object is only
+        # deleted once it was unreferenced for the grace period, which takes at least two collections
+        # Recent objects are kept as well since they might belong to an upload whose manifest is not written yet
+        log("S3", f"Collecting garbage in {bucket}/{CAS_PREFIX}...")
+        previous = self.load_gc_candidates(bucket)
+        referenced = set()
+        manifests = self.list_manifests(bucket)
+        if not self.mark_manifests(bucket, manifests, referenced):
+            return
+
+        now = time.time()
+        unreferenced = {}
+        for prefix in [CAS_BLOBS, f"{CAS_PREFIX}{PACKS_DIR}"]:
+            for obj in self.s3.list_objects(bucket, prefix, True):
+                name = obj.object_name.rsplit("/", 1)[-1].removesuffix(PACK_EXTENSION)
+                if name not in referenced and now - obj.last_modified.timestamp() > grace_period:
+                    unreferenced[name] = obj.object_name
+
+        # Manifests saved during the mark can reference objects which were unreferenced before, they are marked again
+        changed = [
+            remote_prefix for remote_prefix, obj in self.list_manifests(bucket).items()
+            if remote_prefix not in manifests or obj.etag != manifests[remote_prefix].etag
+        ]
+        if not self.mark_manifests(bucket, changed, referenced):
+            return
+        candidates = { object_name: previous.get(object_name, now) for name, object_name in unreferenced.items() if name not in referenced }
+        garbage = [object_name for object_name, since in candidates.items() if now - since > grace_period]
+
+        deleted = set(garbage) - self.remove_objects(bucket, garbage)
+        self.save_gc_candidates(bucket, { object_name: since for object_name, since in candidates.items() if object_name not in deleted })
+        log("S3", f"Garbage collection completed! Deleted {len(deleted)} out of {len(candidates)} unreferenced objects")
+    
+    def upload_directory(self, local_dir, bucket, remote_prefix, workers = 8, progress_callback = None, callback_interval = 1.0, hash_index = None, pack_threshold = 0, pack_size = 64 * 1024 * 1024, hash_workers = HASH_WORKERS, max_workers = MAX_WORKERS, adaptive = False, chunk_threshold = 0):
+        if not self.s3.bucket_exists(bucket):
+            log("S3", f"Bucket {bucket} does not exist. Skipping upload")
+            return
+
+        with self.metrics.phase("manifest"):
+            manifest = self.load_manifest(bucket, remote_prefix)
+            if manifest is None:
+                manifest = self.list_manifest(bucket, remote_prefix)
+            previous_chunk_lists = set(manifest.chunks)
+            previous_chunks = manifest.referenced_chunks()
+            self.known_chunks.update(previous_chunks)
+            if self.layout == LAYOUT_CAS and not manifest.files:
+                # a new cache id usually shares most content with other ids, a single listing is cheaper than checking every blob
+                log("S3", f"Listing existing blobs in {bucket}/{CAS_BLOBS}...")
+                self.load_known_blobs(bucket)
+
+        # Enumerating, hashing and uploading run concurrently, each stage only holds a bounded number of files
+        enumeration = { "files": 0, "done": False }
+        def enumerate_files():
+            start = time.time()
+            grouper = PackGrouper(pack_size)
+            for full_path, relative_path, size in self.walk_files(local_dir):
                 # skip lock files in the lib folder
                 if relative_path.endswith("-lock"):
                     continue
 
-                s3_key = f"{remote_prefix}{relative_path}"
-                all_files.append((full_path, s3_key))
+                enumeration["files"] += 1
+                file = (full_path, relative_path, f"{remote_prefix}{relative_path}", size)
+                if size < pack_threshold:
+                    group = grouper.add(file)
+                    if group:
+                        yield ("pack", group)
+                else:
+                    yield ("file", file)
+
+            group = grouper.flush()
+            if group:
+                yield ("pack", group)
+            enumeration["done"] = True
+            self.metrics.add_phase("enumerate", start, time.time())
 
-        log("S3", f"Starting upload of {len(all_files)} files with {workers} threads...")
+        def hash_item(item):
+            kind, data = item
+            files = [data] if kind == "file" else data
+            try:
+                with self.metrics.phase("hash"):
+                    return (kind, data, [self.hash_file(file[0], file[1], hash_index) for file in files])
+            except OSError as e:
+                log("S3", f"Failed to hash {files[0][1]}{'' if kind == 'file' else f' (pack of {len(files)} files)'}: {e}")
+                return (kind, data, None)
 
+        def upload_item(item):
+            kind, data, hashes = item
+            if hashes is None:
+                return (kind, data, None)
+
+            limiter.acquire()
+            result = None
+            start = time.time()
+            try:
+                if kind == "file":
+                    full_path, relative_path, s3_key, _ = data
+                    hash, size = hashes[0]
+                    chunked = chunk_threshold > 0 and size >= chunk_threshold
+                    result = self.upload_entry(bucket, remote_prefix, s3_key, full_path, relative_path, manifest, hash, size, chunked)
+                else:
+                    result = self.upload_pack(bucket, remote_prefix, data, manifest, hashes)
+                return (kind, data, result)
+            finally:
+                end = time.time()
+                if kind == "file":
+                    transferred = result[4] if result else 0
+                else:
+                    transferred = sum(size for _, size in hashes) if result and result[0] else 0
+                limiter.release(transferred, result is None or result[0] is None)
+                self.metrics.add_phase("transfer", start, end)
+                if transferred:
+                    self.metrics.add_file(data[1] if kind == "file" else f"pack {result[1]} ({len(data)} files)", transferred, end - start)
+
+        limiter = ConcurrencyLimiter(workers, max_workers if adaptive else workers, adaptive)
+        log("S3", f"Starting upload with {hash_workers} hashing and {limiter.maximum} upload threads{f' (adaptive, starting at {workers})' if adaptive else ''}...")
+
+        keys = []
         uploaded = 0
         skipped = 0
-        total_files = len(all_files)
+        failed = 0
         last_callback_time = time.time()
+        orphans = []
 
-        with ThreadPoolExecutor(workers) as executor:
-            futures = {
-                executor.submit(self.upload_file, bucket, s3_key, full_path): idx
-                for idx, (full_path, s3_key) in enumerate(all_files, 1)
-            }
-
-            for future in as_completed(futures):
-                result = future.result()
+        for kind, data, result in run_pipeline(enumerate_files(), [(hash_item, hash_workers), (upload_item, limiter.maximum)]):
+            files = [data] if kind == "file" else data
+            keys.extend(file[2] for file in files)
+            if result is None or result[0] is None:
+                failed += len(files)
+                self.metrics.add_transfer("failed", len(files), 0)
+            elif kind == "file":
+                result, hash, size, chunks, sent = result
                 uploaded += result
                 skipped += not result
+                if result:
+                    # chunks which exist already are not sent, their bytes count as skipped
+                    self.metrics.add_transfer("uploaded", 1, sent)
+                    if sent < size:
+                        self.metrics.add_transfer("skipped", 0, size - sent)
+                else:
+                    self.metrics.add_transfer("skipped", 1, size)
+                if chunks is not None:
+                    # a file which was stored as a single object before is replaced by its chunks
+                    previous = manifest.files.get(data[1])
+                    if previous and not Manifest.is_packed(previous) and previous[0] not in previous_chunk_lists and self.layout == LAYOUT_PREFIX:
+                        orphans.append(data[2])
+                    manifest.chunks[hash] = chunks
+                manifest.files[data[1]] = [hash, size]
+            else:
+                result, name, members, stored_size = result
+                uploaded += len(members) if result else 0
+                skipped += 0 if result else len(members)
+                self.metrics.add_transfer("uploaded" if result else "skipped", len(members), sum(size for _, _, size in members))
+                manifest.packs[name] = stored_size
+                for member_path, hash, size in members:
+                    previous = manifest.files.get(member_path)
+                    if previous and not Manifest.is_packed(previous) and self.layout == LAYOUT_PREFIX:
+                        orphans.append(f"{remote_prefix}{member_path}")
+                    manifest.files[member_path] = [hash, size, name]
 
-                now = time.time()
-                if progress_callback and (now - last_callback_time) >= callback_interval:
-                    progress = (uploaded + skipped) / float(total_files) * 100.0
-                    progress_callback(progress)
-                    last_callback_time = now
+            now = time.time()
+            if progress_callback and (now - last_callback_time) >= callback_interval:
+                progress_callback(uploaded + skipped + failed, enumeration["files"] if enumeration["done"] else None)
+                last_callback_time = now
 
         if progress_callback:
-            progress_callback(100.0)
-        log("S3", f"Upload completed! {uploaded} uploaded, {skipped} skipped")
+            progress_callback(len(keys), len(keys))
+        log("S3", f"Upload completed! {uploaded} uploaded, {skipped} skipped, {failed} failed")
 
-        return [s3_key for _, s3_key in all_files]
+        # Objects that are no longer referenced can be removed once the new manifest is stored
+        # Shared objects of the content addressed layout are only removed by the garbage collection
+        unreferenced = manifest.unreferenced_packs()
+        for name in unreferenced:
+            if self.layout == LAYOUT_PREFIX:
+                orphans.append(pack_key(remote_prefix, name))
+            del manifest.packs[name]
+        for hash in manifest.unreferenced_chunk_lists():
+            del manifest.chunks[hash]
+        if self.layout == LAYOUT_PREFIX:
+            orphans.extend(chunk_key(remote_prefix, hash) for hash in previous_chunks - manifest.referenced_chunks())
+        with self.metrics.phase("manifest"):
+            self.save_manifest(bucket, remote_prefix, manifest)
+        if orphans:
+            log("S3", f"Removed {len(orphans) - len(self.remove_objects(bucket, orphans))} replaced objects")
 
-    def delete_keys(self, bucket, prefix, exceptions, progress_callback = None, callback_interval = 1.0):
+        if hash_index:
+            log("S3", f"Hash index: {hash_index.hits} hits, {hash_index.misses} misses")
+            hash_index.save()
+
+        return keys
+
+    def delete_keys(self, bucket, prefix, exceptions, progress_callback = None, callback_interval = 1.0, workers = 8):
         if not self.s3.bucket_exists(bucket):
             log("S3", f"Bucket {bucket} does not exist. Skipping delete")
             return
         
         exceptions_set = set(exceptions)
         log("S3", f"Finding unused files in {bucket}/{prefix}...")
-        objects = self.s3.list_objects(bucket, prefix, True)
-        objects = [obj for obj in objects if obj.object_name not in exceptions_set]
+        with self.metrics.phase("manifest"):
+            manifest = self.load_manifest(bucket, prefix)
+            if manifest is None:
+                manifest = self.list_manifest(bucket, prefix)
+        unused = [relative_path for relative_path in manifest.files if f"{prefix}{relative_path}" not in exceptions_set]
 
-        deleted = 0
-        total_objects = len(objects)
-        last_callback_time = time.time()
+        if self.layout == LAYOUT_CAS:
+            for relative_path in unused:
+                del manifest.files[relative_path]
+            for name in manifest.unreferenced_packs():
+                del manifest.packs[name]
+            for hash in manifest.unreferenced_chunk_lists():
+                del manifest.chunks[hash]
+            if unused:
+                self.save_manifest(bucket, prefix, manifest)
+            log("S3", f"Removed {len(unused)} unused files from the manifest of {bucket}/{prefix}")
+            with self.metrics.phase("garbage collection"):
+                self.collect_garbage(bucket)
+            return
 
-        deleted = 0
-        for obj in objects:
-            try:
-                self.s3.remove_object(bucket, obj.object_name)
-                deleted += 1
-            except S3Error as e:
-                log("S3", f"Failed to delete {obj.object_name}")
+        objects = []
+        previous_chunks = manifest.referenced_chunks()
+        for relative_path in unused:
+            entry = manifest.files[relative_path]
+            if Manifest.is_packed(entry) or entry[0] in manifest.chunks:
+                del manifest.files[relative_path]
+            else:
+                objects.append(relative_path)
 
-            now = time.time()
-            if progress_callback and (now - last_callback_time) >= callback_interval:
-                progress = deleted / float(total_objects) * 100.0
-                progress_callback(progress)
-                last_callback_time = now 
-        
+        log("S3", f"Deleting {len(objects)} unused files with {workers} threads...")
+        failed = self.remove_objects(bucket, [f"{prefix}{relative_path}" for relative_path in objects], workers, progress_callback, callback_interval)
+        for relative_path in objects:
+            if f"{prefix}{relative_path}" not in failed:
+                del manifest.files[relative_path]
+
+        if progress_callback:
+            progress_callback(len(objects), len(objects))
+        deleted = len(objects) - len(failed)
         log("S3", f"Deleted {deleted} out of {len(objects)} unused files from {bucket}/{prefix}")
 
-    def download_directory(self, local_dir, bucket, remote_prefix, workers = 8, progress_callback = None, callback_interval = 1.0):
+        unreferenced = manifest.unreferenced_packs()
+        for name in unreferenced:
+            del manifest.packs[name]
+        for hash in manifest.unreferenced_chunk_lists():
+            del manifest.chunks[hash]
+        unreferenced_chunks = previous_chunks - manifest.referenced_chunks()
+        if deleted or len(unused) > len(objects):
+            self.save_manifest(bucket, prefix, manifest)
+        if unreferenced:
+            self.remove_objects(bucket, [self.pack_object_key(prefix, name) for name in unreferenced], workers)
+            log("S3", f"Deleted {len(unreferenced)} unused packs from {bucket}/{prefix}")
+        if unreferenced_chunks:
+            self.remove_objects(bucket, [chunk_key(prefix, hash) for hash in unreferenced_chunks], workers)
+            log("S3", f"Deleted {len(unreferenced_chunks)} unused chunks from {bucket}/{prefix}")
+
+    def download_directory(self, local_dir, bucket, remote_prefix, workers = 8, progress_callback = None, callback_interval = 1.0, hash_index = None, incremental = False, prune = False, hash_workers = HASH_WORKERS, max_workers = MAX_WORKERS, adaptive = False):
         if not self.s3.bucket_exists(bucket):
             log("S3", f"Bucket {bucket} does not exist. Skipping download")
             return
 
-        all_files = []
-        log("S3", f"Listing files in {bucket}/{remote_prefix}...")
-        objects = self.s3.list_objects(bucket, remote_prefix, True)
-        for obj in objects:
-            relative_path = os.path.relpath(obj.object_name, remote_prefix)
-            local_path = self.normalize_path(local_dir, relative_path)
-            all_files.append((local_path, obj.object_name))
+        with self.metrics.phase("manifest"):
+            manifest = self.load_manifest(bucket, remote_prefix)
+            if manifest is None:
+                manifest = self.list_manifest(bucket, remote_prefix)
+
+        # Checking local files and downloading run concurrently, each stage only holds a bounded number of files
+        def enumerate_entries():
+            packs = {}
+            for relative_path, remote in manifest.files.items():
+                local_path = self.normalize_path(local_dir, relative_path)
+                if Manifest.is_packed(remote):
+                    packs.setdefault(remote[2], []).append((local_path, relative_path, remote))
+                else:
+                    yield ("file", (local_path, relative_path, self.object_key(remote_prefix, relative_path, remote[0]), remote))
+            for name, members in packs.items():
+                yield ("pack", (name, members))
+
+        def check_item(item):
+            with self.metrics.phase("hash"):
+                return check(item)
+
+        def check(item):
+            kind, data = item
+            if kind == "file":
+                local_path, relative_path, object_name, remote = data
+                if incremental:
+                    return (kind, data, self.check_entry(bucket, object_name, local_path, relative_path, remote, hash_index))
+                return (kind, data, (True, remote[0]))
+
+            name, members = data
+            if incremental:
+                return (kind, data, self.check_pack(members, hash_index))
+            return (kind, data, { relative_path: local_path for local_path, relative_path, _ in members })
+
+        def download_item(item):
+            kind, data, check = item
+            if kind == "file":
+                local_path, relative_path, object_name, remote = data
+                needed, hash = check
+                if not needed:
+                    return (1, False, 0)
+                count, size = 1, remote[1]
+                chunks = manifest.chunks.get(hash) if hash else None
+                if chunks is not None:
+                    operation = lambda: self.download_chunked_entry(bucket, remote_prefix, local_path, relative_path, hash, size, chunks, hash_index)
+                else:
+                    operation = lambda: self.download_entry(bucket, object_name, local_path, relative_path, hash, size, hash_index)
+            else:
+                name, members = data
+                if not check:
+                    return (len(members), 0, 0)
+                count, size = len(members), sum(remote[1] for _, relative_path, remote in members if relative_path in check)
+                operation = lambda: self.download_pack(bucket, remote_prefix, name, members, check, hash_index)
+
+            limiter.acquire()
+            result = None
+            start = time.time()
+            try:
+                result = operation()
+                return (count, result, size)
+            finally:
+                end = time.time()
+                limiter.release(size if result else 0, result is None)
+                self.metrics.add_phase("transfer", start, end)
+                if result:
+                    self.metrics.add_file(data[1] if kind == "file" else f"pack {data[0]} ({result} files)", size, end - start)
 
-        log("S3", f"Starting download of {len(all_files)} files with {workers} threads...")
+        total_files = len(manifest.files)
+        limiter = ConcurrencyLimiter(workers, max_workers if adaptive else workers, adaptive)
+        log("S3", f"Starting download of {total_files} files with {hash_workers} checking and {limiter.maximum} download threads{f' (adaptive, starting at {workers})' if adaptive else ''}...")
 
         downloaded = 0
-        total_files = len(all_files)
+        skipped = 0
+        failed = 0
         last_callback_time = time.time()
 
-        with ThreadPoolExecutor(workers) as executor:
-            futures = {
-                executor.submit(self.download_file, bucket, object_name, local_path): idx
-                for idx, (local_path, object_name) in enumerate(all_files, 1)
-            }
-
-            for future in as_completed(futures):
-                future.result()
-                downloaded += 1
+        for count, result, size in run_pipeline(enumerate_entries(), [(check_item, hash_workers), (download_item, limiter.maximum)]):
+            if result is None:
+                failed += count
+                self.metrics.add_transfer("failed", count, 0)
+            else:
+                downloaded += result
+                skipped += count - result
+                if result:
+                    self.metrics.add_transfer("downloaded", result, size)
+                if count > result:
+                    self.metrics.add_transfer("skipped", count - result, 0)
 
-                now = time.time()
-                if progress_callback and (now - last_callback_time) >= callback_interval:
-                    progress = downloaded / float(total_files) * 100.0
-                    progress_callback(progress)
-                    last_callback_time = now
+            now = time.time()
+            if progress_callback and (now - last_callback_time) >= callback_interval:
+                progress_callback(downloaded + skipped + failed, total_files)
+                last_callback_time = now
 
         if progress_callback:
-            progress_callback(100.0)
-        log("S3", f"Download completed! {downloaded} files downloaded")
+            progress_callback(total_files, total_files)
+        log("S3", f"Download completed! {downloaded} files downloaded, {skipped} skipped, {failed} failed")
+
+        if prune:
+            if manifest.files:
+                with self.metrics.phase("prune"):
+                    pruned = self.prune_directory(local_dir, manifest)
+                log("S3", f"Pruned {pruned} local files that are not in the cache")
+            else:
+                log("S3", f"Cache {bucket}/{remote_prefix} is empty, skipping prune")
+
+        if hash_index:
+            log("S3", f"Hash index: {hash_index.hits} hits, {hash_index.misses} misses")
+            hash_index.save()
+
+        if self.local_cache:
+            log("S3", f"Local cache: {self.local_cache.hits} hits, {self.local_cache.misses} misses")
+            self.local_cache.trim()
@@ -0,0 +1,60 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from log import *
+
+# The S3 client of the cache action is shared, its directory is appended so the modules of the checkout take precedence
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache"))
+from s3 import S3Client
+
+LFS_PREFIX = "lfs/"
+LFS_CONCURRENCY = 16
+
+def object_path(lfs_dir, oid):
+    # Same layout as the local object store of git lfs
+    return os.path.join(lfs_dir, oid[:2], oid[2:4], oid)
+
+def object_key(prefix, oid):
+    return f"{prefix}{oid[:2]}/{oid[2:4]}/{oid}"
+
+# LFS objects in an S3 bucket by oid, the oid is the sha256 of the content so objects are shared by all branches and repositories
+# Restored objects are placed in .git/lfs/objects before git lfs pull, which then only downloads the remaining objects from Github
+class LfsCache:
+    def __init__(self, s3, bucket, prefix = LFS_PREFIX, workers = LFS_CONCURRENCY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.workers = workers
+
+    def restore_object(self, lfs_dir, oid):
+        key = object_key(self.prefix, oid)
+        if self.s3.remote_hash(self.bucket, key) != oid:
+            return False
+
+        path = object_path(lfs_dir, oid)
+        if not self.s3.download_file(self.bucket, key, path):
+            return False
+        # git lfs trusts the files in its object store, so a corrupted download must not end up there
+        hash, _ = S3Client.compute_file_hash(path)
+        if hash != oid:
+            log("LFS_CACHE", f"Downloaded object {oid} has the hash {hash}, discarding it")
+            os.remove(path)
+            return False
+        return True
+
+    def restore(self, lfs_dir, oids):
+        # Returns the oids which are not in the bucket
+        with ThreadPoolExecutor(self.workers) as executor:
+            results = list(executor.map(lambda oid: self.restore_object(lfs_dir, oid), oids))
+        return [oid for oid, restored in zip(oids, results) if not restored]
+
+    def store_object(self, lfs_dir, oid):
+        path = object_path(lfs_dir, oid)
+        if not os.path.isfile(path):
+            return False
+        return bool(self.s3.upload_file(self.bucket, object_key(self.prefix, oid), path, oid, os.path.getsize(path), check_remote = False))
+
+    def store(self, lfs_dir, oids):
+        # Returns the number of uploaded objects
+        with ThreadPoolExecutor(self.workers) as executor:
+            return sum(executor.map(lambda oid: self.store_object(lfs_dir, oid), oids))